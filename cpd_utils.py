@@ -1,61 +1,251 @@
 import os
 import requests
+import urllib3
 import time
 import subprocess
+import threading
+import hashlib
+import base64
+import json
+import random
+from email.utils import parsedate_to_datetime
 
 BASE_URL = os.getenv('BASE_URL',os.getenv('RUNTIME_ENV_APSX_URL','https://cpd-cpd.apps.cpd.mskcc.org'))
 AUTHENTICATE = '/icp4d-api/v1/authorize'
 HEADERS_AUTH = {'Content-Type':'application/json'}
+TOKEN_REFRESH_MARGIN = int(os.getenv('CPD_TOKEN_REFRESH_MARGIN', 300)) # seconds before expiry to get a new token
+HTTP_POOL_SIZE = int(os.getenv('CPD_HTTP_POOL_SIZE', 32)) # keep-alive connections per host
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
 
-def get_access_token(credentials, host_url=BASE_URL):
+_session = None
+_session_lock = threading.Lock()
+
+_token_cache = {} # (host url, credentials hash) -> (token, expiration timestamp)
+_token_issued = {} # token -> (credentials, host url), to get a new one after a 401 response
+_token_locks = {}
+_token_cache_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Get the requests session shared by all API calls in this process. It keeps up to
+    HTTP_POOL_SIZE connections per host alive (environment variable CPD_HTTP_POOL_SIZE),
+    so consecutive and concurrent requests do not pay a TCP + TLS handshake each time.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                    pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def get_token_expiration(token):
+    """
+    Read the expiration time (unix timestamp, the "exp" claim) from a JWT access token.
+    Same as get_token_expiration_datetime() in wmla-utils/dlicmd.py, which is not available
+    where this module is deployed. Returns None if the token cannot be parsed.
+    
+    token: CPD access token
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+
+def get_access_token(credentials, host_url=BASE_URL, refresh_margin=None, force_refresh=False):
     """
     Authenticate using api key and get CPD access token for API authorization.
+    Tokens are cached per host and credentials until refresh_margin seconds before they expire,
+    so repeated calls do not authenticate again. Safe to call from multiple threads.
+    A token revoked before it expires is replaced by run_with_fault_tolerance() on the first 401
+    response to a request using it, see refresh_access_token().
     
     credentials: a dictionary with key "username" and "api_key"
+    refresh_margin: number of seconds before expiry when a new token is requested, defaults to
+                    environment variable CPD_TOKEN_REFRESH_MARGIN or 300
+    force_refresh: if True, always authenticate and replace the cached token
+    """
+    refresh_margin = TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+    key = get_token_key(credentials, host_url)
+    
+    # one lock per credentials: concurrent callers wait for a single authentication round trip
+    with get_token_lock(key):
+        if not force_refresh and key in _token_cache:
+            token, expiration = _token_cache[key]
+            if time.time() < expiration - refresh_margin:
+                return token
+        return authenticate(key, credentials, host_url)
+
+
+def refresh_access_token(token):
+    """
+    Get a new access token in place of one obtained from get_access_token() that the server
+    rejected, e.g., because it was revoked before it expired. The cached token is replaced, so
+    later calls to get_access_token() do not return the rejected one. If another thread already
+    replaced it, its new token is returned without authenticating again.
+    
+    token: the rejected access token
+    
+    Returns the new token, or None if the token was not obtained from get_access_token().
+    """
+    with _token_cache_lock:
+        issued = _token_issued.get(token)
+    if issued is None:
+        return None
+    credentials, host_url = issued
+    key = get_token_key(credentials, host_url)
+    with get_token_lock(key):
+        if key in _token_cache and _token_cache[key][0] != token:
+            return _token_cache[key][0]
+        return authenticate(key, credentials, host_url)
+
+
+def authenticate(key, credentials, host_url):
+    """
+    Request a new access token and cache it, called by the holder of the lock of key.
     """
     requests_args = {'url': host_url+AUTHENTICATE,
                      'headers': HEADERS_AUTH,
                      'json': credentials,
                      'verify': False}
     
-    out = run_with_fault_tolerance(requests.post,requests_args,
-                                   return_object=".json()['token']")
+    # getting a token changes nothing on the server side, so it is safe to retry after any error
+    out = run_with_fault_tolerance(get_session().post,requests_args,idempotent=True,
+                                   return_object=lambda res: res.json()['token'])
+    
+    expiration = get_token_expiration(out)
+    with _token_cache_lock:
+        if expiration is not None:
+            _token_cache[key] = (out, expiration)
+            _token_issued[out] = (credentials, host_url)
+        else: # unknown expiry, never reuse it
+            _token_cache.pop(key, None)
     return out
 
 
+def get_token_key(credentials, host_url):
+    return (host_url, hashlib.sha256(json.dumps(credentials, sort_keys=True).encode()).hexdigest())
+
+
+def get_token_lock(key):
+    with _token_cache_lock:
+        return _token_locks.setdefault(key, threading.Lock())
+
+
 def run_with_fault_tolerance(function, params, status_code_pass=[200], 
-                             return_raw=False, return_object='None', retry=5):
+                             return_raw=False, return_object=None, retry=5,
+                             backoff=1, backoff_max=60, idempotent=None):
     """
     Executes a function in a fualt-tolerant manner. Currently it is only feasible for API requests.
+    Failed attempts are retried with exponential backoff and jitter; a Retry-After header in the
+    response takes precedence over the backoff. Connection errors and timeouts are retried as well.
+    A 401 response to a request authorized with a token from get_access_token() is retried once
+    right away with a new token, see refresh_access_token().
 
-    function: a function to execute
+    function: a function to execute, e.g., get_session().get
     params: a dictionary of parameters/arguments to be passed to the function
     status_code_pass: a list of acceptable status codes indicating success
     return_raw: if True, return the original response object; if False, the returned object is defined by
                 parameter return_object
-    return_object: a string of what code needs to be executed as the returning object
-                   can be a method (starting with dot) such as ".json()" so it finally returns response.json()
-                   or, can be arbitrary code (not starting with dot) such as "None" so it finally returns None
+    return_object: a callable taking the response, e.g., lambda res: res.json(), whose result is returned;
+                   if None, returns None
+    retry: maximum number of attempts
+    backoff: wait time in seconds after the first failed attempt, doubled after every following one
+    backoff_max: upper limit of the wait time in seconds between two attempts
+    idempotent: whether the request can be sent again after a connection error or timeout, when the
+                server may have received and processed it already; if False, only attempts that could
+                not connect to the server are retried; defaults to False for POST requests (function
+                named "post") and True otherwise
     """
+    idempotent = getattr(function, '__name__', None) != 'post' if idempotent is None else idempotent
+    token_refreshed = False
     count_trial = 0
     while count_trial < retry:
         count_trial += 1
-        res = function(**params)
+        try:
+            res = function(**params)
+        except RETRY_EXCEPTIONS as e:
+            if not idempotent and not is_connection_failed(e):
+                raise Exception(f'FAILED: {e}; not retried as the request may have been processed') from e
+            if count_trial >= retry:
+                raise Exception(f'FAILED: {e}; maximum retry reached') from e
+            wait = get_backoff(count_trial, backoff, backoff_max)
+            print(f'FAILED: {e}; wait for {wait:.1f}s and retry...')
+            time.sleep(wait)
+            continue
 
         if res.status_code in status_code_pass:
             if return_raw:
                 return res
-            elif return_object.startswith('.'):
-                return eval('res'+return_object)
+            elif return_object is not None:
+                return return_object(res)
             else:
-                return eval(return_object)
+                return None
         else:
             print(f'FAILED: status code {res.status_code}')
+            if res.status_code == 401 and not token_refreshed and count_trial < retry:
+                token_refreshed = True
+                headers = params.get('headers') or {}
+                token = refresh_access_token(headers.get('Authorization', '')[len('Bearer '):])
+                if token is not None:
+                    print('FAILED: access token rejected; retry with a new one...')
+                    params = {**params, 'headers': {**headers, 'Authorization': f'Bearer {token}'}}
+                    continue
             if count_trial < retry:
-                print(f'FAILED: {res.text}; wait for 3s and retry...')
-                time.sleep(3)
+                wait = get_retry_after(res)
+                wait = get_backoff(count_trial, backoff, backoff_max) if wait is None else wait
+                print(f'FAILED: {res.text}; wait for {wait:.1f}s and retry...')
+                time.sleep(wait)
             else:
                 raise Exception(f'FAILED: {res.text}; maximum retry reached')
+
+
+def is_connection_failed(e):
+    """
+    Whether a requests exception was raised before the request was sent, i.e., no connection
+    to the server could be made, so that sending it again cannot process it twice.
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) > 0 else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+def get_backoff(count_trial, backoff=1, backoff_max=60):
+    """
+    Wait time before the next attempt: exponential in the number of failed attempts, capped by
+    backoff_max, with random jitter so that concurrent clients do not retry in lockstep.
+    """
+    wait = min(backoff_max, backoff * 2 ** (count_trial - 1))
+    return random.uniform(wait / 2, wait)
+
+
+def get_retry_after(res):
+    """
+    Parse the Retry-After header of a response (seconds or an HTTP date) into seconds to wait.
+    Returns None if the header is absent or cannot be parsed.
+    """
+    value = res.headers.get('Retry-After') if res.headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
                 
                 
 def run_cmd(cmd,verbose=0):
@@ -3,8 +3,17 @@ import urllib
 import os
 import time
 import pandas as pd
+import numpy as np
 import urllib3
 import datetime
+import hashlib
+import uuid
+import tempfile
+import zipfile
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from cpd_utils import *
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -19,11 +28,23 @@ HEADERS_POST = {'Content-Type':'application/json',
 HEADERS_GET = {'Authorization':'Bearer {access_token}'}
 HEADERS_PUT = {'Authorization':'Bearer {access_token}'}
 
+MONTHS = {m:f'{i+1:02d}' for i,m in enumerate(['Jan','Feb','Mar','Apr','May','Jun',
+                                                'Jul','Aug','Sep','Oct','Nov','Dec'])}
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+LISTING_CACHE_TTL = float(os.getenv('SV_LISTING_CACHE_TTL', 60)) # seconds a directory listing is reused in-process
+LISTING_INDEX_TTL = float(os.getenv('SV_LISTING_INDEX_TTL', 0)) # seconds a listing on disk answers most_recent queries, 0 disables
+LISTING_INDEX_DIR = os.getenv('SV_LISTING_INDEX_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'storage_volume_index'))
+
+_listing_cache = {} # (host url, volume, path, params) -> (listing timestamp, directory contents)
+_listing_cache_lock = threading.Lock()
+
 
 def list_files(path, volume_display_name=None, 
                params = {'include_details':'true','recursive':'true'}, 
                access_token=None, host_url=BASE_URL, 
-               return_df=False, files_only=False, most_recent=None, file_extensions=None,verbose=0):
+               return_df=False, files_only=False, most_recent=None, file_extensions=None,verbose=0,
+               use_cache=True):
     """
     Given dir path on storage volume, return a list of files and metadata.
     
@@ -34,6 +55,12 @@ def list_files(path, volume_display_name=None,
     most_recent: an integer in day to filter the most recent files/directories
     file_extensions: a list of acceptable file extensions, e.g., ['.png','.json']
                      this will force files_only to be true
+    use_cache: if True, reuse a listing of the same path made in this process within the last
+               SV_LISTING_CACHE_TTL seconds (default 60); if SV_LISTING_INDEX_TTL is set (opt-in, default 0),
+               queries with most_recent also reuse a listing saved on local disk within that many seconds,
+               so that repeated runs do not list large directories again. Uploads through this module
+               invalidate both, but files added by other clients are only seen once the listing expires.
+               Use False to always list the directory from the storage volume.
     """
     volume_display_name = fill_in_default_if_none(volume_display_name,'VOLUME_DISPLAY_NAME','DeepLIIFData')
     access_token = fill_in_default_if_none(access_token,'USER_ACCESS_TOKEN')
@@ -42,55 +69,215 @@ def list_files(path, volume_display_name=None,
         path = '/' # '' triggers error; use / to inspect the root folder
 
     if files_only or most_recent is not None or file_extensions is not None:
-        params['include_details'] = 'true'
+        params = {**params, 'include_details':'true'}
         
     if file_extensions is not None:
         files_only=True
     
-    requests_args = {'url': host_url+LISTFILES.format(volume_display_name=volume_display_name, path_encoded=encode_path(path)),
-                     'headers': fill_in_access_token(HEADERS_GET,access_token),
-                     'params': params,
-                     'verify': False}
-    if verbose > 0:
-        print(requests_args['url'])
-    out = run_with_fault_tolerance(requests.get,requests_args,status_code_pass=[200,404],return_raw=True)
+    out = get_listing(path, volume_display_name, params, access_token, host_url,
+                      use_cache=use_cache, use_index=use_cache and most_recent is not None and LISTING_INDEX_TTL > 0,
+                      verbose=verbose)
 
-    if out.status_code == 404:
+    if out is None:
         return None
     else:
-        out = out.json().get('responseObject').get('directoryContents')
+        return filter_listing(out, files_only, file_extensions, most_recent, return_df)
 
-        if files_only:
-            out = [metadata for metadata in out if metadata['type']=='file']
 
-        if file_extensions is not None:
-            out = [metadata for metadata in out if metadata['file_extension'] in file_extensions]
+def filter_listing(out, files_only=False, file_extensions=None, most_recent=None, return_df=False):
+    """
+    Apply the list_files() filters to a directory listing in a single pass. The type and extension
+    checks are combined into one predicate, and the remaining last_modified values are parsed and
+    compared all at once in pandas instead of calling datetime.strptime per entry.
+    
+    out: a list of file metadata, as returned by the storage volumes api
+    """
+    if files_only or file_extensions is not None:
+        file_extensions = None if file_extensions is None else set(file_extensions)
+        out = [metadata for metadata in out
+               if (not files_only or metadata['type']=='file')
+               and (file_extensions is None or metadata['file_extension'] in file_extensions)]
+
+    if most_recent is not None and len(out) > 0:
+        dt_current = datetime.datetime.now()
+        last_modified = parse_last_modified(pd.Series([metadata['last_modified'] for metadata in out]))
+        mask = ((dt_current - last_modified).dt.days <= most_recent).values
+        out = [out[i] for i in np.flatnonzero(mask)]
+
+    if return_df:
+        return pd.DataFrame(out)
+    else:
+        return out
+
 
-        if most_recent is not None:
-            dt_current = datetime.datetime.now()
+def parse_last_modified(last_modified):
+    """
+    Parse a Series of last_modified strings in RFC 1123 format ('%a, %d %b %Y %H:%M:%S GMT'),
+    all at once. The fixed-width fields are rearranged into ISO 8601, which pandas parses in C,
+    rather than calling datetime.strptime per entry. Like strptime with %Z, the result is naive.
+    Any value that does not parse raises ValueError, as with strptime, instead of becoming NaT.
+    """
+    s = last_modified.astype(str)
+    iso = s.str[12:16] + '-' + s.str[8:11].map(MONTHS) + '-' + s.str[5:7] + 'T' + s.str[17:25]
+    if not iso.isna().any(): # an unknown month leaves NaN, which would parse to NaT
+        try:
+            return pd.to_datetime(iso, format='%Y-%m-%dT%H:%M:%S')
+        except ValueError: # not the expected fixed-width format
+            pass
+    parsed = pd.to_datetime(s, format='%a, %d %b %Y %H:%M:%S %Z').dt.tz_localize(None)
+    if parsed.isna().any(): # empty values parse to NaT
+        raise ValueError(f'cannot parse last_modified {s[parsed.isna()].iloc[0]!r}')
+    return parsed
+
+
+def get_listing(path, volume_display_name, params, access_token, host_url=BASE_URL,
+                use_cache=True, use_index=False, verbose=0):
+    """
+    Get the raw directory contents of a path on storage volume, or None if it does not exist.
+    
+    use_cache: reuse a listing made in this process within LISTING_CACHE_TTL seconds
+    use_index: reuse a listing saved in LISTING_INDEX_DIR within LISTING_INDEX_TTL seconds, and save
+               the listing there after fetching it
+    """
+    key = (host_url, volume_display_name, path, tuple(sorted(params.items())))
+    now = time.time()
+    
+    entry = None
+    if use_cache:
+        with _listing_cache_lock:
+            entry = _listing_cache.get(key)
+        if entry is not None and now - entry[0] > LISTING_CACHE_TTL:
+            entry = None
+    if entry is None and use_index:
+        entry = read_listing_index(key)
+        if entry is not None and now - entry[0] > LISTING_INDEX_TTL:
+            entry = None
+    
+    if entry is None:
+        requests_args = {'url': host_url+LISTFILES.format(volume_display_name=volume_display_name, path_encoded=encode_path(path)),
+                         'headers': fill_in_access_token(HEADERS_GET,access_token),
+                         'params': params,
+                         'verify': False}
+        if verbose > 0:
+            print(requests_args['url'])
+        out = run_with_fault_tolerance(get_session().get,requests_args,status_code_pass=[200,404],return_raw=True)
+        
+        contents = None if out.status_code == 404 else out.json().get('responseObject').get('directoryContents')
+        entry = (now, contents)
+    
+    if use_index:
+        path_index = get_listing_index_path(key)
+        if not os.path.exists(path_index) or os.path.getmtime(path_index) < entry[0]:
+            write_listing_index(key, entry)
+    
+    if use_cache:
+        with _listing_cache_lock:
+            _listing_cache[key] = entry
+    
+    # copies, so that callers modifying the metadata do not modify the cache
+    return None if entry[1] is None else [dict(metadata) for metadata in entry[1]]
 
-            out_recent = []
-            for metadata in out:
-                days_passed = (dt_current - datetime.datetime.strptime(metadata['last_modified'], '%a, %d %b %Y %H:%M:%S %Z')).days
-                if days_passed <= most_recent:
-                    out_recent.append(metadata)
-            out = out_recent.copy()
 
-        if return_df:
-            return pd.DataFrame(out)
+def invalidate_listing_cache(path=None, volume_display_name=None):
+    """
+    Drop cached listings (in-process and on disk) that a change to path on storage volume may
+    have made outdated, i.e., listings of path itself and of all its parent directories.
+    
+    path: a changed file or directory on storage volume; None drops all listings
+    volume_display_name: only drop listings of this storage volume; None for all storage volumes
+    """
+    # the listings of path and of its parents: '', 'a', 'a/b' for 'a/b'
+    l_path_outdated = None
+    if path is not None:
+        parts = normalize_listing_path(path).split('/')
+        l_path_outdated = [''] + ['/'.join(parts[:i]) for i in range(1, len(parts) + 1) if parts[0] != '']
+    
+    def is_outdated(key):
+        _, volume, path_listed, _ = key
+        if volume_display_name is not None and volume != volume_display_name:
+            return False
+        return l_path_outdated is None or normalize_listing_path(path_listed) in l_path_outdated
+    
+    with _listing_cache_lock:
+        for key in [key for key in _listing_cache if is_outdated(key)]:
+            del _listing_cache[key]
+    
+    # saved listings are grouped in directories by volume and path, removed without reading any listing
+    if volume_display_name is not None:
+        l_dir_volume = [get_listing_index_dir(volume_display_name)]
+    elif os.path.isdir(LISTING_INDEX_DIR):
+        l_dir_volume = [os.path.join(LISTING_INDEX_DIR, name) for name in os.listdir(LISTING_INDEX_DIR)]
+    else:
+        l_dir_volume = []
+    for dir_volume in l_dir_volume:
+        if l_path_outdated is None:
+            shutil.rmtree(dir_volume, ignore_errors=True)
         else:
-            return out
+            for path_outdated in l_path_outdated:
+                shutil.rmtree(os.path.join(dir_volume, encode_path('/' + path_outdated)), ignore_errors=True)
+
+
+def normalize_listing_path(path):
+    return (path[2:] if path.startswith('./') else path).strip('/')
+
+
+def get_listing_index_dir(volume_display_name, path=None):
+    """
+    Directory of the listings of path on a storage volume saved by write_listing_index, or of all
+    paths on the storage volume if path is None.
+    """
+    dir_volume = os.path.join(LISTING_INDEX_DIR, encode_path(volume_display_name))
+    return dir_volume if path is None else os.path.join(dir_volume, encode_path('/' + normalize_listing_path(path)))
+
+
+def get_listing_index_path(key):
+    _, volume_display_name, path, _ = key
+    return os.path.join(get_listing_index_dir(volume_display_name, path),
+                        hashlib.sha1(json.dumps(key).encode()).hexdigest() + '.json')
+
+
+def read_listing_index(key):
+    """
+    Read a listing saved by write_listing_index, as (listing timestamp, directory contents),
+    or None if there is none.
+    """
+    try:
+        with open(get_listing_index_path(key)) as f:
+            index = json.load(f)
+        return index['listed_at'], index['contents']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_listing_index(key, entry):
+    """
+    Save a listing (listing timestamp, directory contents) to the local index, atomically so that
+    concurrent readers never see a partial file.
+    """
+    path_index = get_listing_index_path(key)
+    path_tmp = f'{path_index}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path_index), exist_ok=True)
+        with open(path_tmp, 'w') as f:
+            json.dump({'key': key, 'listed_at': entry[0], 'contents': entry[1]}, f)
+        os.replace(path_tmp, path_index)
+    except OSError as e:
+        print(f'Failed to save listing index: {e}')
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+
 
 def upload(path_source, path_target=None,
            volume_display_name=None, 
-           access_token=None, host_url=BASE_URL, keep_source_folder_structure=True):
+           access_token=None, host_url=BASE_URL, keep_source_folder_structure=True, max_workers=None,
+           bundle=False, path_target_type=None):
     """
     Upload a local file to a storage volume.
     
     path_source: the path in your "local"/"current" environment for the file to be uploaded
                  can handle a directory:
                    storage volumes api does not support uploading a whole directory in one request
-                   send one upload request per file
+                   send one upload request per file, max_workers requests at a time
     path_target: the path in storage volume as the destination
                  if a folder is provided instead of a filename, the file(s) will be uploaded to this folder
                  with sub-folder structure remained
@@ -103,27 +290,59 @@ def upload(path_source, path_target=None,
                                       final target path = '/mnts/<volume>/xyz/abc/def.g' vs. '/mnts/<volume>/xyz/def.g'
                                     #3 path target = 'xyz/z.z'
                                       final target path = '/mnts/<volume>/xyz/z.z' vs. '/mnts/<volume>/xyz/z.z'
+    max_workers: number of files uploaded concurrently, defaults to environment variable SV_MAX_WORKERS or 8
+    bundle: if True and there is more than one file, send all files as one zip archive that the storage
+            volumes api extracts on the server side (query parameter extract=true), instead of one
+            request per file
+    path_target_type: "file" or "directory" if already known for path_target (or path_source if path_target
+                      is not specified), which saves a listing of its parent directory
+    """
+    upload_batch([path_source], path_target, volume_display_name, access_token, host_url,
+                 keep_source_folder_structure, max_workers, bundle, path_target_type)
+    
+
+def upload_batch(l_path_source, path_target=None,
+                 volume_display_name=None, 
+                 access_token=None, host_url=BASE_URL, keep_source_folder_structure=True, max_workers=None,
+                 bundle=False, path_target_type=None):
+    """
+    l_path_source: a list of paths to single files, or directories, or a mix of both
+    max_workers: number of files uploaded concurrently, defaults to environment variable SV_MAX_WORKERS or 8
+    bundle: if True, upload all files as one zip archive extracted on the server side, see upload()
+    path_target_type: "file" or "directory" if already known for all target paths, see upload()
+    
+    See upload() for the other parameters. Each target directory is listed only once to resolve
+    the target paths, then the files are uploaded concurrently.
     """
     volume_display_name = fill_in_default_if_none(volume_display_name,'VOLUME_DISPLAY_NAME','DeepLIIFData')
     access_token = fill_in_default_if_none(access_token,'USER_ACCESS_TOKEN')
+    max_workers = int(fill_in_default_if_none(max_workers,'SV_MAX_WORKERS',8))
+    
+    for path_source in l_path_source:
+        if not os.path.exists(path_source):
+            raise Exception(f'Local path {path_source} does not exist.')
     
-    if not os.path.exists(path_source):
-        raise Exception(f'Local path {path_source} does not exist.')
-        
     # later may want to modify the string in uptream (here) than downstream (file_or_dir)
 #     if path_source.startswith('./'):
 #         path_source = path_source[2:]
     
-    if os.path.isfile(path_source):
-        l_path_source = [path_source]
-    else:
-        l_path_source = list_files_local(path_source)
-    
+    l_path_source_files = []
     for path_source in l_path_source:
+        if os.path.isfile(path_source):
+            l_path_source_files.append(path_source)
+        else:
+            l_path_source_files += list_files_local(path_source)
+    
+    listing_cache = {}
+    l_path_target_final = []
+    for path_source in l_path_source_files:
         path_target_final = path_source if path_target is None else path_target
-        path_target_type = file_or_dir(path_target_final,volume_display_name,access_token,host_url)
+        path_target_final_type = path_target_type
+        if path_target_final_type is None:
+            path_target_final_type = file_or_dir(path_target_final,volume_display_name,access_token,host_url,
+                                                 listing_cache=listing_cache)
 
-        if path_target_type == 'directory':
+        if path_target_final_type == 'directory':
             if keep_source_folder_structure:
                 path_target_final = f"{path_target_final}/{path_source}"
             else:
@@ -131,34 +350,142 @@ def upload(path_source, path_target=None,
         else:
             if not keep_source_folder_structure:
                 path_target_final = f"{os.path.basename(path_source)}"
-                
-        requests_args = {'url': BASE_URL+FILES.format(volume_display_name=volume_display_name, 
-                                                      path_encoded=encode_path(path_target_final)),
-                         'headers': fill_in_access_token(HEADERS_PUT,access_token),
-                         'files': {'upFile':(path_source,open(path_source, 'rb'))},
-                         'verify': False}
-
-        run_with_fault_tolerance(requests.put,requests_args)
+        l_path_target_final.append(path_target_final)
+    
+    if bundle and len(l_path_source_files) > 1:
+        upload_bundle(l_path_source_files, l_path_target_final, volume_display_name, access_token, host_url)
+        for path_target_dir in set(os.path.dirname(p) for p in l_path_target_final):
+            invalidate_listing_cache(path_target_dir, volume_display_name)
+        return
+    
+    def upload_file(path_source, path_target_final):
+        url = host_url+FILES.format(volume_display_name=volume_display_name, 
+                                    path_encoded=encode_path(path_target_final))
+        t_s = time.time()
+        run_with_fault_tolerance(put_file,{'url': url,
+                                           'headers': fill_in_access_token(HEADERS_PUT,access_token),
+                                           'path_source': path_source})
         
-        print(f'Success, file uploaded to {path_target_final}')
+        size_mb = os.path.getsize(path_source) / 1024 / 1024
+        print(f'Success, file uploaded to {path_target_final} '
+              f'({size_mb:.2f} MB, {size_mb/max(time.time() - t_s, 1e-6):.2f} MB/s)')
+    
+    t_s = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(upload_file, l_path_source_files, l_path_target_final))
+    finally:
+        for path_target_dir in set(os.path.dirname(p) for p in l_path_target_final):
+            invalidate_listing_cache(path_target_dir, volume_display_name)
     
+    if len(l_path_source_files) > 1:
+        print_throughput('uploaded', [os.path.getsize(p) for p in l_path_source_files], time.time() - t_s)
 
-def upload_batch(l_path_source, path_target=None,
-                 volume_display_name=None, 
-                 access_token=None, host_url=BASE_URL):
+
+def upload_bundle(l_path_source, l_path_target, volume_display_name, access_token, host_url=BASE_URL):
     """
-    l_path_source: a list of paths to single files, or directories, or a mix of both
+    Upload local files as one zip archive which the storage volumes api extracts on the server side,
+    one request instead of one per file. The archive is built in a temporary file (stored, not
+    compressed, as the outputs are png files already) and removed from both sides afterwards.
+    
+    l_path_source: a list of local file paths
+    l_path_target: the target path on storage volume for each file in l_path_source
     """
-    volume_display_name = fill_in_default_if_none(volume_display_name,'VOLUME_DISPLAY_NAME','DeepLIIFData')
-    access_token = fill_in_default_if_none(access_token,'USER_ACCESS_TOKEN')
+    dir_target = os.path.commonpath([os.path.dirname(p) for p in l_path_target])
+    name_bundle = f'.bundle-{uuid.uuid4().hex}.zip'
+    path_target_bundle = f'{dir_target}/{name_bundle}' if dir_target != '' else name_bundle
     
-    for path_source in l_path_source:
-        upload(path_source,path_target,volume_display_name,access_token,host_url)
+    url = host_url+FILES.format(volume_display_name=volume_display_name, 
+                                path_encoded=encode_path(path_target_bundle))
+    fd, path_bundle = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(path_bundle, 'w', zipfile.ZIP_STORED) as z:
+            for path_source, path_target_final in zip(l_path_source, l_path_target):
+                z.write(path_source, os.path.relpath(path_target_final, dir_target or '.'))
+        
+        t_s = time.time()
+        run_with_fault_tolerance(put_file,{'url': url,
+                                           'headers': fill_in_access_token(HEADERS_PUT,access_token),
+                                           'path_source': path_bundle,
+                                           'params': {'extract':'true'}})
+        print_throughput('uploaded in one bundle', [os.path.getsize(p) for p in l_path_source], time.time() - t_s)
+    finally:
+        os.remove(path_bundle)
+        # the archive itself is not needed on the volume once extracted, nor left behind if the
+        # extraction failed after it was uploaded
+        requests_args = {'url': url,
+                         'headers': fill_in_access_token(HEADERS_GET,access_token),
+                         'verify': False}
+        try:
+            run_with_fault_tolerance(get_session().delete,requests_args,status_code_pass=[200,204,404],retry=2)
+        except Exception as e:
+            print(f'Failed to remove {path_target_bundle} from storage volume: {e}')
+
+
+def put_file(url, headers, path_source, params=None, field='upFile'):
+    """
+    PUT a local file as a multipart/form-data request whose body is streamed from disk in chunks
+    instead of being built in memory. The file is opened per call and closed when the request is
+    done, so it can be passed to run_with_fault_tolerance and every retry sends the whole file.
+    """
+    with MultipartFile(path_source, field) as body:
+        return get_session().put(url, data=body, params=params, verify=False,
+                                 headers={**headers, 'Content-Type': body.content_type})
+
+
+class MultipartFile:
+    """
+    File-like multipart/form-data body with a single file field, equivalent to what
+    requests sends for files={field: (path, open(path,'rb'))}. It has a known length, so
+    requests sends a Content-Length header and reads the body in chunks while sending.
+    """
+    def __init__(self, path, field='upFile'):
+        boundary = uuid.uuid4().hex
+        # the part headers are rendered by urllib3 as for requests, including how the filename is quoted
+        part = urllib3.fields.RequestField(name=field, data=b'', filename=path)
+        part.make_multipart()
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.parts = [f'--{boundary}\r\n'.encode() + part.render_headers().encode(),
+                      None, # file content
+                      f'\r\n--{boundary}--\r\n'.encode()]
+        self.f = open(path, 'rb')
+        self.length = len(self.parts[0]) + os.path.getsize(path) + len(self.parts[2])
+        self.buffer = b''
+        self.idx_part = 0
+    
+    def __len__(self):
+        return self.length
+    
+    def read(self, size=-1):
+        size = self.length if size is None or size < 0 else size
+        while len(self.buffer) < size and self.idx_part < len(self.parts):
+            part = self.parts[self.idx_part]
+            if part is None:
+                chunk = self.f.read(size - len(self.buffer))
+                if chunk:
+                    self.buffer += chunk
+                    continue
+            else:
+                self.buffer += part
+            self.idx_part += 1
+        out, self.buffer = self.buffer[:size], self.buffer[size:]
+        return out
+    
+    def close(self):
+        self.f.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
     
 
 def download(path_source, path_target=None,
              volume_display_name=None, params={},
-             access_token=None, host_url=BASE_URL,verbose=0):
+             access_token=None, host_url=BASE_URL,verbose=0,path_source_type=None,
+             checksum=None, retry=5):
     """
     Download a file from storage volume to local environment.
     
@@ -171,14 +498,29 @@ def download(path_source, path_target=None,
                  with sub-folder structure remained
     params: use {"compress":"zip"} if you want to download a folder as an archive
             {"compress":"zip"} will be used anyway if a folder is provided in path_source
+    path_source_type: "file" or "directory" if already known, which saves a listing of the parent directory
+    checksum: optional expected digest of the downloaded file, in the form "<algorithm>:<hex digest>"
+              (e.g., "sha256:9f86d0..."); a mismatch removes the download and raises an exception
+    retry: maximum number of attempts to complete an interrupted transfer
+    
+    The content is streamed in chunks into a temporary file next to path_target, which is renamed
+    into place only once complete, so large files and zipped directories are never held in memory
+    and path_target never contains a partial download. If the transfer breaks off and the server
+    supports Range requests, the next attempt continues where the previous one stopped; this needs an
+    ETag or Last-Modified header in the first response to make sure the file did not change in between,
+    without one the next attempt starts over.
+    
+    Returns the local path of the downloaded file.
     """
     volume_display_name = fill_in_default_if_none(volume_display_name,'VOLUME_DISPLAY_NAME','DeepLIIFData')
     access_token = fill_in_default_if_none(access_token,'USER_ACCESS_TOKEN')
+    params = params.copy() # never modify the caller's (or the default) dict
     
     if path_source[-1] == '/':
         path_source = path_source[:-1]
     
-    path_source_type = file_or_dir(path_source,volume_display_name,access_token,host_url)
+    if path_source_type is None:
+        path_source_type = file_or_dir(path_source,volume_display_name,access_token,host_url)
     if path_source_type == 'directory':
         params['compress'] = 'zip'
 
@@ -188,13 +530,11 @@ def download(path_source, path_target=None,
         if os.path.isdir(path_target):
             path_target = os.path.join(path_target,path_source)
     
-    requests_args = {'url': BASE_URL+FILES.format(volume_display_name=volume_display_name, path_encoded=encode_path(path_source)),
+    requests_args = {'url': host_url+FILES.format(volume_display_name=volume_display_name, path_encoded=encode_path(path_source)),
                      'headers': fill_in_access_token(HEADERS_GET,access_token),
                      'params': params,
+                     'stream': True,
                      'verify': False}
-
-    out = run_with_fault_tolerance(requests.get,requests_args,
-                                   return_raw=True)
     
     if (os.path.dirname(path_target) != ''): # a parent dir will be '' if the path doesn't have one ('abc')
         os.makedirs(os.path.dirname(path_target),exist_ok=True)
@@ -202,24 +542,89 @@ def download(path_source, path_target=None,
     if 'compress' in params:
         path_target += f".{params['compress']}"
 
-    with open(path_target,'wb') as f:
-        f.write(out.content)
+    path_tmp = os.path.join(os.path.dirname(path_target), f'.{os.path.basename(path_target)}.{uuid.uuid4().hex}.part')
+    open(path_tmp, 'wb').close()
+    try:
+        headers = requests_args['headers']
+        validator = None
+        count_trial = 0
+        while True:
+            count_trial += 1
+            size_done = os.path.getsize(path_tmp)
+            requests_args['headers'] = headers
+            if size_done > 0 and validator is not None:
+                # resume, unless the file changed since the first attempt (If-Range) in which case the
+                # server sends the whole file again with status 200; without a validator, the partial
+                # file may be of another version, so the whole file is requested again
+                requests_args['headers'] = {**headers, 'Range': f'bytes={size_done}-', 'If-Range': validator}
+            out = run_with_fault_tolerance(get_session().get,requests_args,
+                                           status_code_pass=[200,206],return_raw=True)
+            if out.status_code == 200:
+                validator = out.headers.get('ETag', out.headers.get('Last-Modified'))
+            
+            size_expected = get_download_size(out)
+            try:
+                with out, open(path_tmp, 'ab' if out.status_code == 206 else 'wb') as f:
+                    for chunk in out.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                size_done = os.path.getsize(path_tmp)
+                if size_expected is None or size_done >= size_expected:
+                    break
+                error = f'connection closed after {size_done} of {size_expected} bytes'
+            except RETRY_EXCEPTIONS as e:
+                error = str(e)
+            
+            if count_trial >= retry:
+                raise Exception(f'FAILED: download of {path_source} interrupted, {error}; maximum retry reached')
+            wait = get_backoff(count_trial)
+            print(f'FAILED: download of {path_source} interrupted, {error}; wait for {wait:.1f}s and resume...')
+            time.sleep(wait)
+        
+        if checksum is not None:
+            algorithm, digest_expected = checksum.split(':', 1)
+            digest = file_digest(path_tmp, algorithm)
+            if digest != digest_expected.lower():
+                raise Exception(f'FAILED: checksum mismatch for {path_source}, expected {digest_expected}, got {digest}')
+        
+        os.replace(path_tmp, path_target)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
     
     if verbose > 0:
         print(f'Success, file downloaded to {path_target}')
+    return path_target
 
 
 def download_batch(l_path_source, path_target=None,
                    volume_display_name=None, params={},
-                   access_token=None, host_url=BASE_URL,verbose=0):
+                   access_token=None, host_url=BASE_URL,verbose=0,max_workers=None):
     """
     l_path_source: a list of paths to single files, or directories, or a mix of both
+    max_workers: number of files downloaded concurrently, defaults to environment variable SV_MAX_WORKERS or 8
+    
+    Each parent directory is listed only once to tell files from directories, then the paths
+    are downloaded concurrently.
     """
     volume_display_name = fill_in_default_if_none(volume_display_name,'VOLUME_DISPLAY_NAME','DeepLIIFData')
     access_token = fill_in_default_if_none(access_token,'USER_ACCESS_TOKEN')
+    max_workers = int(fill_in_default_if_none(max_workers,'SV_MAX_WORKERS',8))
     
-    for path_source in l_path_source:
-        download(path_source,path_target,volume_display_name,params,access_token,host_url,verbose)
+    listing_cache = {}
+    l_path_source_type = [file_or_dir(path_source.rstrip('/'),volume_display_name,access_token,host_url,
+                                      listing_cache=listing_cache)
+                          for path_source in l_path_source]
+    
+    def download_one(path_source, path_source_type):
+        return download(path_source,path_target,volume_display_name,params,access_token,host_url,verbose,
+                        path_source_type)
+    
+    t_s = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        l_path_downloaded = list(executor.map(download_one, l_path_source, l_path_source_type))
+    
+    if len(l_path_downloaded) > 1:
+        print_throughput('downloaded', [os.path.getsize(p) for p in l_path_downloaded], time.time() - t_s)
 
 
 
@@ -251,6 +656,46 @@ def fill_in_default_if_none(var,env_var=None,default=None):
         return var
 
 
+def print_throughput(action, l_size, seconds):
+    """
+    Print the aggregate throughput of a batch transfer.
+    
+    action: e.g., "uploaded" or "downloaded"
+    l_size: a list of file sizes in bytes
+    seconds: wall time of the transfer
+    """
+    seconds = max(seconds, 1e-6)
+    size_mb = sum(l_size) / 1024 / 1024
+    print(f'{len(l_size)} file(s) {action}, {size_mb:.1f} MB in {seconds:.1f}s '
+          f'({len(l_size)/seconds:.1f} files/s, {size_mb/seconds:.2f} MB/s)')
+
+
+def get_download_size(res):
+    """
+    Get the total number of bytes the local file will have once a (partial) download response
+    is written, from Content-Range for 206 responses and Content-Length otherwise.
+    Returns None if the size is unknown, e.g., for compressed or chunked responses.
+    """
+    if res.status_code == 206:
+        total = res.headers.get('Content-Range', '').split('/')[-1]
+        return int(total) if total.isdigit() else None
+    if 'Content-Encoding' in res.headers:
+        return None
+    length = res.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+
+def file_digest(path, algorithm='sha256'):
+    """
+    Compute the hex digest of a local file in chunks, e.g., to verify a download.
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def encode_path(path):
     return urllib.parse.quote(path, safe='')
 
@@ -261,12 +706,14 @@ def fill_in_access_token(headers,access_token):
 
 
 def file_or_dir(path, volume_display_name=None,
-                access_token=None, host_url=BASE_URL):
+                access_token=None, host_url=BASE_URL, listing_cache=None):
     """
     Examines whether an EXISTING path points to a file or a directory on storage volume.
     If the path does not exist, calls file_or_dir_guess() to make a guess.
     
     path: do NOT end with /
+    listing_cache: optional dictionary of parent directory -> listing, shared across calls so that
+                   a batch of paths in the same directory lists it only once
     """
     volume_display_name = fill_in_default_if_none(volume_display_name,'VOLUME_DISPLAY_NAME','DeepLIIFData')
     access_token = fill_in_default_if_none(access_token,'USER_ACCESS_TOKEN')
@@ -277,8 +724,13 @@ def file_or_dir(path, volume_display_name=None,
         path_parent = path_parent[2:]
     path_base = os.path.basename(path)
     
-    l_meta = list_files(path_parent, volume_display_name,{'include_details':'true','recursive':'false'},
-                        access_token,host_url)
+    if listing_cache is not None and path_parent in listing_cache:
+        l_meta = listing_cache[path_parent]
+    else:
+        l_meta = list_files(path_parent, volume_display_name,{'include_details':'true','recursive':'false'},
+                            access_token,host_url)
+        if listing_cache is not None:
+            listing_cache[path_parent] = l_meta
     
     if l_meta is None: # this happens when the parent path does not exist in storage volume
         print(f'{path} cannot be found on storage volume (yet), returned the guessed type')
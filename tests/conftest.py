@@ -0,0 +1,18 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+# the utility modules are flat files at the repository root
+DIR_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIR_REPO)
+
+# the deepliif package is only shipped as the deployment's deepliif.zip, extracted as the kernel does
+PATH_DEEPLIIF_ZIP = os.path.join(DIR_REPO, 'wmla-deployment', 'edi-deployment-dirs', 'deepliif-base', 'deepliif.zip')
+DIR_DEEPLIIF = tempfile.mkdtemp(prefix='deepliif-')
+atexit.register(shutil.rmtree, DIR_DEEPLIIF, ignore_errors=True)
+with zipfile.ZipFile(PATH_DEEPLIIF_ZIP) as z:
+    z.extractall(os.path.join(DIR_DEEPLIIF, 'deepliif'))
+sys.path.insert(1, DIR_DEEPLIIF)
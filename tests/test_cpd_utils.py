@@ -0,0 +1,206 @@
+import base64
+import email.utils
+import json
+import socket
+import threading
+import time
+from unittest import mock
+
+import pytest
+import requests
+
+import cpd_utils
+
+
+def make_token(expiration, n):
+    """An unsigned JWT with an "exp" claim; n tells the tokens of one test apart"""
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': expiration, 'n': n}).encode()).decode().rstrip('=')
+    return f'header.{payload}.signature'
+
+
+class MockAuthServer:
+    """Authentication and one api behind a mocked session; the api answers 401 to the revoked tokens"""
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.tokens = []
+        self.revoked = set()
+        self.revoke_all = False
+        self.lock = threading.Lock()
+        self.session = mock.Mock()
+        self.session.post.side_effect = self.post
+        self.session.get.side_effect = self.get
+
+    def post(self, url, json=None, **kwargs):
+        time.sleep(0.05) # so that concurrent callers overlap
+        with self.lock:
+            token = make_token(time.time() + self.lifetime if self.lifetime is not None else None, len(self.tokens))
+            self.tokens.append(token)
+        return mock.Mock(status_code=200, headers={}, json=mock.Mock(return_value={'token': token}))
+
+    def get(self, url, headers=None, **kwargs):
+        token = headers['Authorization'][len('Bearer '):]
+        if self.revoke_all or token in self.revoked:
+            return mock.Mock(status_code=401, text='token revoked', headers={})
+        return mock.Mock(status_code=200, text=token, headers={})
+
+
+@pytest.fixture
+def auth_server(monkeypatch):
+    server = MockAuthServer()
+    monkeypatch.setattr(cpd_utils, 'get_session', lambda: server.session)
+    monkeypatch.setattr(cpd_utils, 'get_backoff', lambda *args: 0)
+    monkeypatch.setattr(cpd_utils, '_token_cache', {})
+    monkeypatch.setattr(cpd_utils, '_token_issued', {})
+    monkeypatch.setattr(cpd_utils, '_token_locks', {})
+    return server
+
+
+CREDENTIALS = {'username': 'user', 'api_key': 'key'}
+
+
+def test_token_cached_until_refresh_margin(auth_server):
+    token = cpd_utils.get_access_token(CREDENTIALS, 'https://host')
+    assert cpd_utils.get_access_token(dict(reversed(list(CREDENTIALS.items()))), 'https://host') == token
+    assert cpd_utils.get_access_token(CREDENTIALS, 'https://other') != token # cached per host
+    assert cpd_utils.get_access_token({**CREDENTIALS, 'api_key': 'other'}, 'https://host') != token
+    assert len(auth_server.tokens) == 3
+
+    assert cpd_utils.get_access_token(CREDENTIALS, 'https://host', refresh_margin=3600 + 60) != token
+    assert cpd_utils.get_access_token(CREDENTIALS, 'https://host', force_refresh=True) == auth_server.tokens[-1]
+    assert len(auth_server.tokens) == 5
+
+
+def test_token_without_expiration_not_cached(auth_server):
+    auth_server.lifetime = None
+    tokens = [cpd_utils.get_access_token(CREDENTIALS, 'https://host') for _ in range(2)]
+    assert tokens == auth_server.tokens and tokens[0] != tokens[1]
+
+
+def test_token_concurrent_callers_authenticate_once(auth_server):
+    barrier = threading.Barrier(8)
+    tokens = []
+
+    def get_token():
+        barrier.wait()
+        tokens.append(cpd_utils.get_access_token(CREDENTIALS, 'https://host'))
+
+    threads = [threading.Thread(target=get_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == auth_server.tokens * 8
+
+
+def get_api(token, retry=5):
+    return cpd_utils.run_with_fault_tolerance(cpd_utils.get_session().get,
+                                              {'url': 'https://host/api', 'headers': {'Authorization': f'Bearer {token}'}},
+                                              return_object=lambda res: res.text, retry=retry)
+
+
+def test_revoked_token_refreshed_once_on_401(auth_server):
+    token = cpd_utils.get_access_token(CREDENTIALS, 'https://host')
+    auth_server.revoked.add(token)
+
+    # the request is sent again right away with a new token, which replaces the cached one
+    token_new = get_api(token)
+    assert token_new != token and auth_server.tokens == [token, token_new]
+    assert cpd_utils.get_access_token(CREDENTIALS, 'https://host') == token_new
+
+    # a caller still holding the old token gets the new one without authenticating again
+    assert get_api(token) == token_new
+    assert len(auth_server.tokens) == 2
+
+    # a token rejected again is not refreshed again within the same call
+    auth_server.revoke_all = True
+    with mock.patch.object(cpd_utils, 'refresh_access_token', wraps=cpd_utils.refresh_access_token) as refresh:
+        with pytest.raises(Exception, match='token revoked'):
+            get_api(token_new, retry=3)
+    assert refresh.call_count == 1 and len(auth_server.tokens) == 3
+
+
+def test_401_with_unknown_token_is_not_refreshed(auth_server):
+    auth_server.revoked.add('foreign')
+    with pytest.raises(Exception, match='token revoked'):
+        get_api('foreign', retry=2)
+    assert auth_server.tokens == []
+
+
+@pytest.fixture
+def closing_server():
+    """A server that accepts connections and closes them without answering, i.e., after the request was sent"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            connection.recv(65536)
+            connections.append(connection)
+            connection.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f'http://127.0.0.1:{server.getsockname()[1]}', connections
+    server.close()
+
+
+def get_closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def post(**kwargs):
+    return requests.post(timeout=5, **kwargs)
+
+
+def test_post_not_retried_after_it_was_sent(closing_server, monkeypatch):
+    monkeypatch.setattr(cpd_utils, 'get_backoff', lambda *args: 0)
+    url, connections = closing_server
+    with pytest.raises(Exception, match='not retried') as excinfo:
+        cpd_utils.run_with_fault_tolerance(post, {'url': url, 'json': {}})
+    assert isinstance(excinfo.value.__cause__, requests.exceptions.ConnectionError)
+    assert len(connections) == 1
+
+    # unless it is declared idempotent, like requests of other methods
+    with pytest.raises(Exception, match='maximum retry reached'):
+        cpd_utils.run_with_fault_tolerance(post, {'url': url, 'json': {}}, retry=3, idempotent=True)
+    assert len(connections) == 4
+
+
+def test_post_retried_when_it_could_not_connect(monkeypatch):
+    monkeypatch.setattr(cpd_utils, 'get_backoff', lambda *args: 0)
+    function = mock.Mock(side_effect=post)
+    function.__name__ = 'post'
+    with pytest.raises(Exception, match='maximum retry reached') as excinfo:
+        cpd_utils.run_with_fault_tolerance(function, {'url': f'http://127.0.0.1:{get_closed_port()}'}, retry=3)
+    assert isinstance(excinfo.value.__cause__, requests.exceptions.ConnectionError)
+    assert function.call_count == 3
+
+
+def test_get_backoff_exponential_with_jitter():
+    for count_trial, wait in [(1, 1), (2, 2), (3, 4), (6, 32), (7, 60), (20, 60)]:
+        waits = [cpd_utils.get_backoff(count_trial) for _ in range(200)]
+        assert wait / 2 <= min(waits) and max(waits) <= wait
+        assert max(waits) - min(waits) > wait / 4 # not in lockstep
+    assert cpd_utils.get_backoff(3, backoff=0.5, backoff_max=1.5) <= 1.5
+
+
+@pytest.mark.parametrize('value,expected', [('120', 120), ('0', 0), ('-5', 0), ('1.5', 1.5),
+                                            (None, None), ('soon', None), ('', None)])
+def test_get_retry_after(value, expected):
+    res = mock.Mock(headers={} if value is None else {'Retry-After': value})
+    assert cpd_utils.get_retry_after(res) == expected
+
+
+def test_get_retry_after_http_date():
+    res = mock.Mock(headers={'Retry-After': email.utils.formatdate(time.time() + 30, usegmt=True)})
+    assert 28 <= cpd_utils.get_retry_after(res) <= 30
+    res = mock.Mock(headers={'Retry-After': email.utils.formatdate(time.time() - 30, usegmt=True)})
+    assert cpd_utils.get_retry_after(res) == 0
+    assert cpd_utils.get_retry_after(mock.Mock(headers=None)) is None
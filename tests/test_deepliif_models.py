@@ -0,0 +1,293 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('numba')
+from PIL import Image
+
+from deepliif.models import postprocess, create_postprocess_executor, init_nets, inference, load_onnx_models, OnnxNet, \
+    quantize_net, get_net_artifacts, TwoStageExecutor, forward_batch, run_dask_batch, TileBatcher, run_dask, \
+    is_batchable, compute_batch_size, prepare_batching, inference_streaming
+import deepliif.models
+from deepliif.data import transform
+from deepliif.util import open_image_lazy
+from deepliif.util.util import tensor_to_pil
+from deepliif.models.networks import ResnetGenerator, UnetGenerator, get_norm_layer
+
+
+def test_postprocess_with_reused_pool_matches_serial():
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (160, 200, 3), dtype=np.uint8))
+    seg_img = Image.fromarray(rng.integers(0, 256, (160, 200, 3), dtype=np.uint8))
+
+    expected_images, expected_scoring = postprocess(img, seg_img, tile_size=48)
+    with create_postprocess_executor(2) as executor:
+        for _ in range(2): # the same pool serves consecutive calls
+            images, scoring = postprocess(img, seg_img, tile_size=48, executor=executor)
+            assert scoring == expected_scoring
+            for name in expected_images:
+                assert np.array_equal(np.array(images[name]), np.array(expected_images[name])), name
+
+
+NET_NAMES = ['G1', 'G2', 'G3', 'G4', 'G51', 'G52', 'G53', 'G54', 'G55']
+
+
+def tiny_net(name):
+    """A net with the DeepLIIF architecture of net name (ResnetGenerator or UnetGenerator), but 4 filters wide."""
+    norm_layer = get_norm_layer(norm_type='batch')
+    if name in ['G1', 'G2', 'G3', 'G4']:
+        return ResnetGenerator(3, 3, 4, norm_layer=norm_layer, use_dropout=True, n_blocks=1)
+    return UnetGenerator(3, 3, 5, 4, norm_layer=norm_layer, use_dropout=True)
+
+
+@pytest.fixture(scope='module')
+def tiny_nets():
+    """The nine nets, tiny and in eval mode (so batching applies)"""
+    torch.manual_seed(0)
+    return {name: tiny_net(name).eval() for name in NET_NAMES}
+
+
+def random_tiles(rng, n, size=64):
+    return [Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)) for _ in range(n)]
+
+
+def to_batch(imgs):
+    return torch.cat([transform(img.resize((512, 512))) for img in imgs])
+
+
+def test_two_stage_executor_matches_dask(tiny_nets):
+    rng = np.random.default_rng(0)
+    batches = [random_tiles(rng, n) for n in [2, 3, 1, 2]] # sizes change, so the reused buffers are resized and sliced
+    executor = TwoStageExecutor(tiny_nets)
+    try:
+        outputs = []
+        for imgs, outs in zip(batches, executor.map(to_batch(imgs) for imgs in batches)):
+            expected = forward_batch(to_batch(imgs), tiny_nets)
+            assert set(outs) == set(expected)
+            for k in expected:
+                assert torch.equal(outs[k], expected[k]), k
+            # yielded tensors are only valid until the next batch is requested
+            outputs.append([{k: tensor_to_pil(v[b:b + 1]) for k, v in outs.items()} for b in range(len(imgs))])
+        for imgs, outs in zip(batches, outputs):
+            for out, expected in zip(outs, run_dask_batch(imgs, nets=tiny_nets)):
+                for k in expected:
+                    assert np.array_equal(np.array(out[k]), np.array(expected[k])), k
+
+        # forward returns copies, which later batches do not overwrite
+        results = [executor.forward(to_batch(imgs)) for imgs in batches]
+        for imgs, outs in zip(batches, results):
+            expected = forward_batch(to_batch(imgs), tiny_nets)
+            for k in expected:
+                assert torch.equal(outs[k], expected[k]), k
+    finally:
+        executor.close()
+
+
+def assert_images_close(outs, expected):
+    """Results of a tile batched differently may differ by rounding of the 8-bit images"""
+    assert set(outs) == set(expected)
+    for k in expected:
+        assert np.abs(np.array(outs[k], dtype=int) - np.array(expected[k], dtype=int)).max() <= 1, k
+
+
+def test_tile_batcher_returns_each_caller_its_own_results(tiny_nets, monkeypatch):
+    batch_sizes = []
+    def forward_batch_recorded(ts, nets):
+        batch_sizes.append(ts.shape[0])
+        return forward_batch(ts, nets)
+    monkeypatch.setattr(deepliif.models, 'forward_batch', forward_batch_recorded)
+
+    rng = np.random.default_rng(0)
+    requests = [random_tiles(rng, n) for n in [3, 1, 2, 4]]
+    results = [None] * len(requests)
+    batcher = TileBatcher(tiny_nets, max_batch_size=4, max_wait=0.5)
+    start = threading.Barrier(len(requests))
+
+    def run(k):
+        start.wait()
+        results[k] = batcher.run(requests[k])
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(len(requests))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    assert sum(batch_sizes) == 10 and max(batch_sizes) > 1 and max(batch_sizes) <= 4
+    for imgs, outs in zip(requests, results):
+        assert len(outs) == len(imgs)
+        for out, expected in zip(outs, run_dask_batch(imgs, nets=tiny_nets)):
+            assert_images_close(out, expected)
+
+
+def test_tile_batcher_close_finishes_pending_tiles(tiny_nets):
+    rng = np.random.default_rng(0)
+    imgs = random_tiles(rng, 3)
+    batcher = TileBatcher(tiny_nets, max_batch_size=8, max_wait=600)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(batcher.run(imgs)))
+    thread.start()
+    # wait until the batcher took all tiles and waits for more to batch with
+    while batcher.queue.unfinished_tasks < len(imgs) or batcher.queue.qsize() > 0:
+        time.sleep(0.01)
+    batcher.close()
+    thread.join(timeout=60)
+
+    assert not thread.is_alive() and len(results[0]) == len(imgs)
+    for out, expected in zip(results[0], run_dask_batch(imgs, nets=tiny_nets)):
+        assert_images_close(out, expected)
+    with pytest.raises(RuntimeError):
+        batcher.run(imgs)
+
+
+def test_batched_inference_matches_tile_by_tile(tiny_nets):
+    rng = np.random.default_rng(0)
+    imgs = random_tiles(rng, 3)
+    for out, img in zip(run_dask_batch(imgs, nets=tiny_nets), imgs):
+        assert_images_close(out, run_dask(img, nets=tiny_nets))
+
+    img = random_tiles(rng, 1, size=160)[0]
+    expected = inference(img, tile_size=64, overlap_size=16, nets=tiny_nets, batch_size=1)
+    assert_images_close(inference(img, tile_size=64, overlap_size=16, nets=tiny_nets, batch_size=4), expected)
+
+
+def test_batching_falls_back_to_one_tile_in_training_mode(tiny_nets):
+    assert is_batchable(tiny_nets)
+    assert prepare_batching(4, nets=tiny_nets) == (tiny_nets, 4)
+    assert prepare_batching(4, max_batch_memory=2 * deepliif.models.TILE_MEMORY_MB, nets=tiny_nets) == (tiny_nets, 2)
+
+    training_nets = {**tiny_nets, 'G3': tiny_net('G3').train()}
+    assert not is_batchable(training_nets)
+    assert prepare_batching(4, nets=training_nets) == (training_nets, 1)
+    batcher = TileBatcher(training_nets, max_batch_size=4)
+    assert batcher.max_batch_size == 1
+    batcher.close()
+
+
+def test_compute_batch_size_caps_memory():
+    assert compute_batch_size(8) == 8
+    assert compute_batch_size(8, max_batch_memory=3 * deepliif.models.TILE_MEMORY_MB) == 3
+    assert compute_batch_size(8, max_batch_memory=1) == 1
+    assert compute_batch_size(0) == 1
+
+
+@pytest.mark.parametrize('size', [(128, 192), (150, 170)])
+def test_inference_streaming_matches_inference(tiny_nets, tmp_path, size):
+    tifffile = pytest.importorskip('tifffile')
+    height, width = size
+    tile_size, overlap_size = 64, 16
+    pix = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    path = str(tmp_path / 'slide.tif')
+    tifffile.imwrite(path, pix, photometric='rgb', tile=(32, 32), compression='zlib')
+
+    with open_image_lazy(path) as img:
+        outputs = inference_streaming(img, str(tmp_path / 'slide'), tile_size, overlap_size, nets=tiny_nets)
+
+    # the last row and column of tiles are padded with white instead of resizing the image to a multiple
+    # of tile_size, i.e., the same as inference on the image padded with white to a multiple of tile_size
+    padded = np.full((-(-height // tile_size) * tile_size, -(-width // tile_size) * tile_size, 3), 255, dtype=np.uint8)
+    padded[:height, :width] = pix
+    expected = inference(Image.fromarray(padded), tile_size, overlap_size, nets=tiny_nets)
+    assert set(outputs) == set(expected)
+    for name, path_output in outputs.items():
+        assert np.array_equal(np.load(path_output), np.array(expected[name])[:height, :width]), name
+
+
+@pytest.mark.parametrize('name', ['G1', 'G51'])
+@pytest.mark.parametrize('precision,mean_tolerance,max_tolerance', [('int8', 0.1, 0.5), ('bf16', 0.01, 0.05)])
+def test_quantize_net_traces_saves_and_reloads(tmp_path, name, precision, mean_tolerance, max_tolerance):
+    torch.manual_seed(0)
+    net = tiny_net(name)
+    calibration_inputs = [torch.rand(1, 3, 64, 64) * 2 - 1 for _ in range(4)]
+    quantized = quantize_net(net, precision, calibration_inputs)
+    assert net.training # the net passed in is not modified
+
+    quantized.save(str(tmp_path / f'{name}.{precision}.pt'))
+    reloaded = torch.jit.load(str(tmp_path / f'{name}.{precision}.pt'))
+    x = torch.rand(2, 3, 64, 64) * 2 - 1
+    with torch.no_grad():
+        expected = net.eval()(x)
+        y = reloaded(x)
+    assert y.dtype == torch.float32 and y.shape == expected.shape
+    error = (y - expected).abs()
+    assert error.mean().item() <= mean_tolerance and error.max().item() <= max_tolerance
+
+
+def test_get_net_artifacts_identifies_the_loaded_files(tmp_path):
+    model_dir = tmp_path / 'model'
+    model_dir.mkdir()
+    sample = torch.rand(1, 3, 32, 32)
+    for name in NET_NAMES:
+        torch.jit.trace(tiny_net(name).eval(), sample).save(str(model_dir / f'{name}.pt'))
+    archive = shutil.make_archive(str(tmp_path / 'model'), 'zip', str(model_dir))
+
+    artifacts = get_net_artifacts(init_nets(str(model_dir)))
+    assert artifacts['G1'].startswith(f'{model_dir}/G1.pt|None|')
+    artifacts_zip = get_net_artifacts(init_nets(archive))
+    assert artifacts_zip['G1'].startswith(f'{archive}|G1.pt|')
+
+    # a net file replaced in place is told apart
+    nets = init_nets(str(model_dir))
+    stat = os.stat(model_dir / 'G1.pt')
+    os.utime(model_dir / 'G1.pt', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert get_net_artifacts(nets)['G1'] != artifacts['G1']
+    assert get_net_artifacts(nets)['G2'] == artifacts['G2']
+
+
+@pytest.fixture(scope='module')
+def onnx_model_dir(tmp_path_factory):
+    """Tiny nets with the DeepLIIF architectures, traced to <net>.pt and exported to <net>.onnx the way
+    `cli.py export-onnx` does."""
+    pytest.importorskip('onnxruntime')
+    model_dir = str(tmp_path_factory.mktemp('onnx_models'))
+    sample = torch.rand(1, 3, 512, 512) * 2 - 1 # the tile size the nets are run at, only the batch is dynamic
+    manifest = {'nets': {}}
+    torch.manual_seed(0)
+    for name in NET_NAMES:
+        net = tiny_net(name).eval()
+        with torch.no_grad():
+            kwargs = dict(input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+            try:
+                torch.onnx.export(net, sample, f'{model_dir}/{name}.onnx', dynamo=False, **kwargs)
+            except TypeError: # torch < 2.5 has no dynamo exporter to opt out of
+                torch.onnx.export(net, sample, f'{model_dir}/{name}.onnx', **kwargs)
+            torch.jit.trace(net, sample).save(f'{model_dir}/{name}.pt')
+        manifest['nets'][name] = {'torchscript': f'{name}.pt', 'onnx': f'{name}.onnx'}
+    with open(f'{model_dir}/manifest.json', 'w') as f:
+        json.dump(manifest, f)
+    return model_dir
+
+
+def test_onnx_nets_match_torchscript(onnx_model_dir):
+    names = ['G1', 'G51']
+    onnx_nets = load_onnx_models(onnx_model_dir, names)
+    archive = shutil.make_archive(os.path.join(os.path.dirname(onnx_model_dir), 'onnx_models'), 'zip', onnx_model_dir)
+    onnx_nets_zip = load_onnx_models(archive, names)
+    x = torch.rand(2, 3, 512, 512) * 2 - 1 # a batch size other than the exported one
+    for name in names:
+        assert isinstance(onnx_nets[name], OnnxNet)
+        expected = torch.jit.load(f'{onnx_model_dir}/{name}.pt')(x)
+        assert torch.allclose(onnx_nets[name](x), expected, atol=1e-4), name
+        assert torch.allclose(onnx_nets_zip[name](x), expected, atol=1e-4), name
+
+
+def test_onnxruntime_backend_matches_torchscript(onnx_model_dir):
+    onnx_nets = init_nets(onnx_model_dir, backend='onnxruntime')
+    torchscript_nets = init_nets(onnx_model_dir)
+    assert all(isinstance(net, OnnxNet) for net in onnx_nets.values())
+    assert get_net_artifacts(onnx_nets)['G1'].startswith(f'{onnx_model_dir}/G1.onnx|None|')
+
+    img = Image.fromarray(np.random.default_rng(0).integers(0, 256, (96, 96, 3), dtype=np.uint8))
+    expected = inference(img, tile_size=96, overlap_size=0, nets=torchscript_nets)
+    images = inference(img, tile_size=96, overlap_size=0, nets=onnx_nets)
+    for name in expected:
+        diff = np.abs(np.array(images[name], dtype=int) - np.array(expected[name], dtype=int))
+        assert diff.max() <= 1, name # outputs within rounding of the 8-bit images
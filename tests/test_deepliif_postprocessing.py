@@ -0,0 +1,207 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+skimage = pytest.importorskip('skimage')
+import skimage.measure
+import scipy.ndimage as ndi
+
+from deepliif.postprocessing import remove_background_noise, remove_cell_noise, overlay_final_segmentation_mask, \
+    create_final_segmentation_mask_with_boundaries, overlay_final_segmentation_mask_parallel, overlay_margin, \
+    compute_cell_mapping, remove_noises
+
+
+# -------- implementations before component bounding boxes were used, as references --------
+def remove_background_noise_reference(mask, mask_boundary):
+    labeled = skimage.measure.label(mask, background=0)
+    padding = 5
+    for i in range(1, len(np.unique(labeled))):
+        component = np.zeros_like(mask)
+        component[labeled == i] = mask[labeled == i]
+        component_bound = np.zeros_like(mask_boundary)
+        component_bound[max(0, min(np.nonzero(component)[0]) - padding): min(mask_boundary.shape[1],
+                                                                             max(np.nonzero(component)[0]) + padding),
+        max(0, min(np.nonzero(component)[1]) - padding): min(mask_boundary.shape[1],
+                                                             max(np.nonzero(component)[1]) + padding)] \
+            = mask_boundary[max(0, min(np.nonzero(component)[0]) - padding): min(mask_boundary.shape[1], max(
+            np.nonzero(component)[0]) + padding),
+              max(0, min(np.nonzero(component)[1]) - padding): min(mask_boundary.shape[1],
+                                                                   max(np.nonzero(component)[1]) + padding)]
+        if len(np.nonzero(component_bound)[0]) < len(np.nonzero(component)[0]) / 3:
+            mask[labeled == i] = 0
+    return mask
+
+
+def remove_cell_noise_reference(mask1, mask2):
+    labeled = skimage.measure.label(mask1, background=0)
+    padding = 2
+    for i in range(1, len(np.unique(labeled))):
+        component = np.zeros_like(mask1)
+        component[labeled == i] = mask1[labeled == i]
+        component_bound = np.zeros_like(mask2)
+        component_bound[
+        max(0, min(np.nonzero(component)[0]) - padding): min(mask2.shape[1], max(np.nonzero(component)[0]) + padding),
+        max(0, min(np.nonzero(component)[1]) - padding): min(mask2.shape[1], max(np.nonzero(component)[1]) + padding)] \
+            = mask2[max(0, min(np.nonzero(component)[0]) - padding): min(mask2.shape[1],
+                                                                         max(np.nonzero(component)[0]) + padding),
+              max(0, min(np.nonzero(component)[1]) - padding): min(mask2.shape[1],
+                                                                   max(np.nonzero(component)[1]) + padding)]
+        if len(np.nonzero(component_bound)[0]) > len(np.nonzero(component)[0]) / 3:
+            mask1[labeled == i] = 0
+            mask2[labeled == i] = 255
+    return mask1, mask2
+
+
+# -------- flood fills before preallocated arrays were used (without numba), as references --------
+def compute_cell_mapping_reference(new_mapping, image_size, small_object_size=20):
+    marked = [[False for _ in range(image_size[1])] for _ in range(image_size[0])]
+    for i in range(image_size[0]):
+        for j in range(image_size[1]):
+            if marked[i][j] is False and (new_mapping[i, j, 0] > 0 or new_mapping[i, j, 2] > 0):
+                cluster_red_no, cluster_blue_no = 0, 0
+                pixels = [(i, j)]
+                cluster = [(i, j)]
+                marked[i][j] = True
+                while len(pixels) > 0:
+                    pixel = pixels.pop()
+                    if new_mapping[pixel[0], pixel[1], 0] > 0:
+                        cluster_red_no += 1
+                    if new_mapping[pixel[0], pixel[1], 2] > 0:
+                        cluster_blue_no += 1
+                    for neigh_i in range(-1, 2):
+                        for neigh_j in range(-1, 2):
+                            neigh_pixel = (pixel[0] + neigh_i, pixel[1] + neigh_j)
+                            if 0 <= neigh_pixel[0] < image_size[0] and 0 <= neigh_pixel[1] < image_size[1] and \
+                                    marked[neigh_pixel[0]][neigh_pixel[1]] is False and (
+                                    new_mapping[neigh_pixel[0], neigh_pixel[1], 0] > 0 or new_mapping[
+                                neigh_pixel[0], neigh_pixel[1], 2] > 0):
+                                cluster.append(neigh_pixel)
+                                pixels.append(neigh_pixel)
+                                marked[neigh_pixel[0]][neigh_pixel[1]] = True
+                cluster_value = None
+                if cluster_red_no < cluster_blue_no:
+                    cluster_value = (0, 0, 255)
+                else:
+                    cluster_value = (255, 0, 0)
+                if len(cluster) < small_object_size:
+                    cluster_value = (0, 0, 0)
+                if cluster_value is not None:
+                    for node in cluster:
+                        new_mapping[node[0], node[1]] = cluster_value
+    return new_mapping
+
+
+def remove_noises_reference(channel, image_size, small_object_size=20):
+    marked = [[False for _ in range(image_size[1])] for _ in range(image_size[0])]
+    for i in range(image_size[0]):
+        for j in range(image_size[1]):
+            if marked[i][j] is False and channel[i, j] > 0:
+                pixels = [(i, j)]
+                cluster = [(i, j)]
+                marked[i][j] = True
+                while len(pixels) > 0:
+                    pixel = pixels.pop()
+                    for neigh_i in range(-1, 2):
+                        for neigh_j in range(-1, 2):
+                            neigh_pixel = (pixel[0] + neigh_i, pixel[1] + neigh_j)
+                            if 0 <= neigh_pixel[0] < image_size[0] and 0 <= neigh_pixel[1] < image_size[1] and \
+                                    marked[neigh_pixel[0]][neigh_pixel[1]] is False and channel[
+                                neigh_pixel[0], neigh_pixel[1]] > 0:
+                                cluster.append(neigh_pixel)
+                                pixels.append(neigh_pixel)
+                                marked[neigh_pixel[0]][neigh_pixel[1]] = True
+
+                cluster_value = None
+                if len(cluster) < small_object_size:
+                    cluster_value = 0
+                if cluster_value is not None:
+                    for node in cluster:
+                        channel[node[0], node[1]] = cluster_value
+    return channel
+
+
+def random_mask(rng, shape, density):
+    """Blobs of 0/255 with a random density, like the masks the postprocessing sees"""
+    return (ndi.uniform_filter(rng.random(shape), 5) > 1 - density).astype(np.uint8) * 255
+
+
+SHAPES = [(64, 64), (48, 80), (80, 48)] # non-square shapes cover the row limits clipped by shape[1]
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_remove_background_noise_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    shape = SHAPES[seed % len(SHAPES)]
+    mask = random_mask(rng, shape, rng.uniform(0.3, 0.5))
+    mask_boundary = random_mask(rng, shape, rng.uniform(0.1, 0.5))
+
+    expected = remove_background_noise_reference(mask.copy(), mask_boundary.copy())
+    assert np.array_equal(remove_background_noise(mask.copy(), mask_boundary.copy()), expected)
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_remove_cell_noise_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    shape = SHAPES[seed % len(SHAPES)]
+    mask1 = random_mask(rng, shape, rng.uniform(0.3, 0.5))
+    mask2 = random_mask(rng, shape, rng.uniform(0.1, 0.5))
+
+    expected1, expected2 = remove_cell_noise_reference(mask1.copy(), mask2.copy())
+    out1, out2 = remove_cell_noise(mask1.copy(), mask2.copy())
+    assert np.array_equal(out1, expected1)
+    assert np.array_equal(out2, expected2)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_compute_cell_mapping_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    shape = SHAPES[seed % len(SHAPES)]
+    new_mapping = np.zeros(shape + (3,), dtype=np.uint8)
+    new_mapping[:, :, 0] = random_mask(rng, shape, rng.uniform(0.2, 0.5))
+    new_mapping[:, :, 1] = rng.integers(0, 256, shape, dtype=np.uint8)
+    new_mapping[:, :, 2] = random_mask(rng, shape, rng.uniform(0.2, 0.5)) # overlaps red, so clusters vote
+    small_object_size = int(rng.integers(1, 60))
+
+    expected = compute_cell_mapping_reference(new_mapping.copy(), shape, small_object_size)
+    assert np.array_equal(compute_cell_mapping(new_mapping.copy(), shape, small_object_size), expected)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_remove_noises_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    shape = SHAPES[seed % len(SHAPES)]
+    channel = random_mask(rng, shape, rng.uniform(0.2, 0.6))
+    small_object_size = int(rng.integers(1, 200))
+
+    expected = remove_noises_reference(channel.copy(), shape, small_object_size)
+    assert np.array_equal(remove_noises(channel.copy(), shape, small_object_size), expected)
+
+
+def random_segmentation(rng, shape):
+    """An image and a segmentation mask with positive (red) and negative (blue) cells"""
+    mask_image = np.zeros(shape + (3,), dtype=np.uint8)
+    positive = random_mask(rng, shape, rng.uniform(0.4, 0.5)) > 0
+    negative = (random_mask(rng, shape, rng.uniform(0.4, 0.5)) > 0) & ~positive
+    mask_image[positive] = (255, 0, 0)
+    mask_image[negative] = (0, 0, 255)
+    return rng.integers(0, 256, shape + (3,), dtype=np.uint8), mask_image
+
+
+@pytest.mark.parametrize('tile_size', [16, 32, 64])
+def test_overlay_parallel_matches_serial(tile_size):
+    rng = np.random.default_rng(tile_size)
+    with ThreadPoolExecutor(2) as executor:
+        for shape in [(100, 140), (150, 90)]:
+            img, mask_image = random_segmentation(rng, shape)
+            overlaid, refined = overlay_final_segmentation_mask_parallel(img, mask_image, tile_size, executor=executor)
+            assert np.array_equal(overlaid, overlay_final_segmentation_mask(img, mask_image))
+            assert np.array_equal(refined, create_final_segmentation_mask_with_boundaries(mask_image))
+
+
+def test_overlay_parallel_rejects_small_margin():
+    img, mask_image = random_segmentation(np.random.default_rng(0), (64, 64))
+    with pytest.raises(ValueError):
+        overlay_final_segmentation_mask_parallel(img, mask_image, 32, margin=overlay_margin() - 1,
+                                                 executor=ThreadPoolExecutor(1))
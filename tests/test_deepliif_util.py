@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import tifffile
+
+from deepliif.util import open_image_lazy, read_region, TiffPageArray
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(tile=(64, 48), compression='zlib'),
+    dict(tile=(32, 32)),
+    dict(rowsperstrip=37, compression='zlib'),
+    dict(rowsperstrip=37, compression='zlib', planarconfig='separate'),
+])
+def test_open_image_lazy_reads_tiled_and_compressed_tiff(tmp_path, kwargs):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (150, 203, 3), dtype=np.uint8)
+    path = str(tmp_path / 'slide.tif')
+    data = np.ascontiguousarray(img.transpose(2, 0, 1)) if kwargs.get('planarconfig') == 'separate' else img
+    tifffile.imwrite(path, data, photometric='rgb', **kwargs)
+
+    with open_image_lazy(path) as lazy:
+        assert isinstance(lazy, TiffPageArray)
+        assert lazy.shape == img.shape
+        for _ in range(20):
+            x, y = rng.integers(-40, 203), rng.integers(-40, 150)
+            assert np.array_equal(np.array(read_region(lazy, x, y, 70, 60)), np.array(read_region(img, x, y, 70, 60)))
+        assert np.array_equal(lazy[:, :, :], img)
+    assert lazy.tif.filehandle.closed
+
+
+def test_open_image_lazy_memory_maps_contiguous_tiff(tmp_path):
+    img = np.random.default_rng(0).integers(0, 256, (50, 60, 3), dtype=np.uint8)
+    path = str(tmp_path / 'slide.tif')
+    tifffile.imwrite(path, img, photometric='rgb')
+
+    lazy = open_image_lazy(path)
+    assert isinstance(lazy, np.memmap)
+    assert np.array_equal(lazy, img)
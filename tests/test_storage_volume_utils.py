@@ -0,0 +1,394 @@
+import datetime
+import email.utils
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+from unittest import mock
+
+import pandas as pd
+import pytest
+import requests
+
+import cpd_utils
+import storage_volume_utils as sv
+
+
+class MockVolume:
+    """Storage volumes api of a single directory, served through a mocked session"""
+    def __init__(self):
+        self.files = []
+        self.session = mock.Mock()
+        self.session.get.side_effect = self.get
+        self.session.put.side_effect = self.put
+
+    def get(self, url, **kwargs):
+        last_modified = email.utils.formatdate(time.time(), usegmt=True)
+        contents = [{'path': name, 'type': 'file', 'file_extension': os.path.splitext(name)[1],
+                     'last_modified': last_modified} for name in self.files]
+        return mock.Mock(status_code=200, headers={},
+                         json=mock.Mock(return_value={'responseObject': {'directoryContents': contents}}))
+
+    def put(self, url, data=None, **kwargs):
+        self.files.append(os.path.basename(urllib.parse.unquote(url)))
+        return mock.Mock(status_code=200, headers={})
+
+
+@pytest.fixture
+def volume(tmp_path, monkeypatch):
+    volume = MockVolume()
+    monkeypatch.setattr(sv, 'get_session', lambda: volume.session)
+    monkeypatch.setattr(sv, 'LISTING_INDEX_DIR', str(tmp_path / 'index'))
+    monkeypatch.setattr(sv, '_listing_cache', {})
+    return volume
+
+
+def list_most_recent(path='ground_truth'):
+    return [m['path'] for m in sv.list_files(path, 'volume', most_recent=1, access_token='token', host_url='https://host')]
+
+
+def test_listing_index_is_opt_in(volume):
+    volume.files = ['a.json']
+    assert list_most_recent() == ['a.json']
+    assert not os.path.exists(sv.LISTING_INDEX_DIR)
+
+    volume.files.append('b.json') # uploaded by another client
+    sv._listing_cache.clear() # a new process
+    assert list_most_recent() == ['a.json', 'b.json']
+
+
+def test_listing_index_invalidated_by_upload(volume, tmp_path, monkeypatch):
+    monkeypatch.setattr(sv, 'LISTING_INDEX_TTL', 3600)
+    volume.files = ['a.json']
+    assert list_most_recent() == ['a.json']
+    assert len(list_listing_index()) == 1
+
+    sv._listing_cache.clear()
+    assert list_most_recent() == ['a.json']
+    assert volume.session.get.call_count == 1 # answered from the index
+
+    path_source = tmp_path / 'b.json'
+    path_source.write_text('{}')
+    sv.upload(str(path_source), 'ground_truth/b.json', 'volume', 'token', 'https://host')
+    assert list_listing_index() == []
+
+    sv._listing_cache.clear()
+    assert list_most_recent() == ['a.json', 'b.json']
+
+
+def list_listing_index():
+    return [os.path.join(dp, f) for dp, dn, fns in os.walk(sv.LISTING_INDEX_DIR) for f in fns]
+
+
+def test_invalidate_listing_cache_without_reading_listings(volume, monkeypatch):
+    monkeypatch.setattr(sv, 'LISTING_INDEX_TTL', 3600)
+    listings = [('volume', '/'), ('volume', 'a'), ('volume', './a/b/'), ('volume', 'a/c'), ('volume', 'a/bc'),
+                ('other', 'a/b')]
+    for volume_display_name, path in listings:
+        sv.get_listing(path, volume_display_name, {}, 'token', 'https://host', use_index=True)
+
+    def assert_listed(expected):
+        assert sorted((key[1], sv.normalize_listing_path(key[2])) for key in sv._listing_cache) == expected
+        assert sorted(map(sv.get_listing_index_path, sv._listing_cache)) == sorted(list_listing_index())
+
+    # the listings of the changed path and its parents, on the same volume
+    with mock.patch.object(sv.json, 'load', side_effect=AssertionError('listing read')):
+        sv.invalidate_listing_cache('a/b/x.png', 'volume')
+    assert_listed([('other', 'a/b'), ('volume', 'a/bc'), ('volume', 'a/c')])
+
+    sv.invalidate_listing_cache('a/b')
+    assert_listed([('volume', 'a/bc'), ('volume', 'a/c')])
+
+    sv.invalidate_listing_cache()
+    assert sv._listing_cache == {} and list_listing_index() == []
+
+
+def filter_listing_reference(out, files_only, file_extensions, most_recent):
+    """The per-entry loops filter_listing replaced"""
+    if files_only:
+        out = [metadata for metadata in out if metadata['type']=='file']
+    if file_extensions is not None:
+        out = [metadata for metadata in out if metadata['file_extension'] in file_extensions]
+    if most_recent is not None:
+        dt_current = datetime.datetime.now()
+        out = [metadata for metadata in out
+               if (dt_current - datetime.datetime.strptime(metadata['last_modified'], '%a, %d %b %Y %H:%M:%S %Z')).days <= most_recent]
+    return out
+
+
+@pytest.mark.parametrize('files_only,file_extensions,most_recent', [(True, None, None), (False, ['.png'], None),
+                                                                     (False, None, 7), (True, ['.png', '.json'], 30)])
+def test_filter_listing_matches_reference(files_only, file_extensions, most_recent):
+    rng = random.Random(0)
+    dt_current = datetime.datetime.now()
+    out = [{'path': f'dir/f{i}.png',
+            'type': rng.choice(['file', 'file', 'file', 'directory']),
+            'file_extension': rng.choice(['.png', '.png', '.json', '']),
+            'size': rng.randint(1, 10**6),
+            # whole days away from the cutoff, so the two calls to now() cannot disagree
+            'last_modified': (dt_current - datetime.timedelta(days=rng.randint(0, 60), hours=rng.randint(1, 22)))
+                             .strftime('%a, %d %b %Y %H:%M:%S GMT')}
+           for i in range(2000)]
+    assert sv.filter_listing(out, files_only, file_extensions, most_recent) == \
+        filter_listing_reference(out, files_only, file_extensions, most_recent)
+
+
+@pytest.mark.parametrize('value', ['Mon, 05 Foo 2024 10:00:00 GMT', 'garbage', ''])
+def test_parse_last_modified_rejects_invalid_values(value):
+    with pytest.raises(ValueError):
+        sv.parse_last_modified(pd.Series(['Mon, 05 Feb 2024 10:00:00 GMT', value]))
+    out = [{'path': 'a', 'type': 'file', 'file_extension': '', 'last_modified': 'Mon, 05 Feb 2024 10:00:00 GMT'},
+           {'path': 'b', 'type': 'file', 'file_extension': '', 'last_modified': value}]
+    with pytest.raises(ValueError):
+        sv.filter_listing(out, most_recent=10**6)
+
+
+class MockFileServer:
+    """Downloads of one file through a mocked session; each response is described by the next entry of
+    replies: (content, validator headers, number of bytes sent before the connection breaks or None)"""
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.session = mock.Mock()
+        self.session.get.side_effect = self.get
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers))
+        content, validators, size_sent = self.replies.pop(0)
+        start = 0
+        validator = validators.get('ETag', validators.get('Last-Modified'))
+        if 'Range' in headers and headers.get('If-Range') == validator:
+            start = int(headers['Range'][len('bytes='):-1])
+        body = content[start:] if size_sent is None else content[start:start + size_sent]
+
+        def iter_content(chunk_size=None):
+            yield body
+            if size_sent is not None:
+                raise requests.exceptions.ChunkedEncodingError('connection broken')
+
+        res = mock.MagicMock(status_code=206 if start > 0 else 200)
+        res.headers = {**validators, 'Content-Length': str(len(content) - start)}
+        if start > 0:
+            res.headers['Content-Range'] = f'bytes {start}-{len(content) - 1}/{len(content)}'
+        res.iter_content.side_effect = iter_content
+        return res
+
+
+@pytest.fixture
+def file_server(monkeypatch):
+    def serve(*replies):
+        server = MockFileServer(replies)
+        monkeypatch.setattr(sv, 'get_session', lambda: server.session)
+        monkeypatch.setattr(sv, 'get_backoff', lambda *args: 0)
+        return server
+    return serve
+
+
+def download(tmp_path, **kwargs):
+    return sv.download('data/f.bin', str(tmp_path / 'f.bin'), 'volume', access_token='token',
+                       host_url='https://host', path_source_type='file', **kwargs)
+
+
+CONTENT = bytes(range(256)) * 40
+
+
+def test_download_resumes_with_range_and_if_range(tmp_path, file_server):
+    server = file_server((CONTENT, {'ETag': '"v1"'}, 1000), (CONTENT, {'ETag': '"v1"'}, None))
+    path = download(tmp_path)
+
+    assert open(path, 'rb').read() == CONTENT
+    assert 'Range' not in server.requests[0]
+    assert server.requests[1]['Range'] == 'bytes=1000-' and server.requests[1]['If-Range'] == '"v1"'
+    assert os.listdir(tmp_path) == ['f.bin'] # the .part file was renamed into place
+
+
+def test_download_restarts_when_the_file_changed(tmp_path, file_server):
+    changed = CONTENT[::-1]
+    server = file_server((CONTENT, {'ETag': '"v1"'}, 1000), (changed, {'ETag': '"v2"'}, 500), (changed, {'ETag': '"v2"'}, None))
+    path = download(tmp_path)
+
+    # the 200 reply to the range request restarts from zero, the next range request uses the new validator
+    assert open(path, 'rb').read() == changed
+    assert server.requests[1]['If-Range'] == '"v1"' and server.requests[2]['If-Range'] == '"v2"'
+    assert server.requests[2]['Range'] == 'bytes=500-'
+
+
+def test_download_does_not_resume_without_validator(tmp_path, file_server):
+    server = file_server((CONTENT, {}, 1000), (CONTENT[::-1], {}, None))
+    path = download(tmp_path)
+
+    assert open(path, 'rb').read() == CONTENT[::-1]
+    assert 'Range' not in server.requests[1] and 'If-Range' not in server.requests[1]
+
+
+def test_download_checksum_mismatch(tmp_path, file_server):
+    file_server((CONTENT, {'ETag': '"v1"'}, None))
+    with pytest.raises(Exception, match='checksum mismatch'):
+        download(tmp_path, checksum='sha256:' + hashlib.sha256(b'other').hexdigest())
+    assert os.listdir(tmp_path) == []
+
+    file_server((CONTENT, {'ETag': '"v1"'}, None))
+    path = download(tmp_path, checksum='sha256:' + hashlib.sha256(CONTENT).hexdigest())
+    assert open(path, 'rb').read() == CONTENT
+
+
+def test_download_gives_up_after_retry(tmp_path, file_server):
+    file_server(*[(CONTENT, {'ETag': '"v1"'}, 100)] * 3)
+    with pytest.raises(Exception, match='maximum retry reached'):
+        download(tmp_path, retry=3)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('name', ['a b.png', 'tile"1".json', 'ünïcode.bin'])
+def test_multipart_file_matches_requests_files(tmp_path, name):
+    path = str(tmp_path / name)
+    content = os.urandom(200_000)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    with open(path, 'rb') as f:
+        expected = requests.Request('PUT', 'https://host/x', files={'upFile': (path, f)}).prepare()
+    boundary_expected = expected.headers['Content-Type'].split('boundary=')[1]
+
+    with sv.MultipartFile(path) as body:
+        chunks = []
+        while True:
+            chunk = body.read(8191) # smaller than the file, not aligned with the parts
+            if not chunk:
+                break
+            chunks.append(chunk)
+        boundary = body.content_type.split('boundary=')[1]
+        assert len(body) == len(expected.body)
+    assert body.f.closed
+    assert b''.join(chunks).replace(boundary.encode(), boundary_expected.encode()) == expected.body
+
+
+def test_upload_bundle_cleans_up_when_extract_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+    os.makedirs(tempfile.tempdir)
+    monkeypatch.setattr(cpd_utils, 'get_backoff', lambda *args: 0)
+    session = mock.Mock()
+    session.put.return_value = mock.Mock(status_code=500, text='extraction failed', headers={})
+    session.delete.return_value = mock.Mock(status_code=204, headers={})
+    monkeypatch.setattr(sv, 'get_session', lambda: session)
+
+    l_path_source = []
+    for name in ['a.png', 'b.png']:
+        (tmp_path / name).write_bytes(os.urandom(100))
+        l_path_source.append(str(tmp_path / name))
+    with pytest.raises(Exception, match='extraction failed'):
+        sv.upload_bundle(l_path_source, ['out/a.png', 'out/b.png'], 'volume', 'token', 'https://host')
+
+    assert os.listdir(tempfile.tempdir) == [] # the local zip
+    url_bundle = session.put.call_args.args[0]
+    assert '.bundle-' in url_bundle and session.put.call_args.kwargs['params'] == {'extract': 'true'}
+    assert session.delete.call_args.kwargs['url'] == url_bundle # the zip uploaded before extraction failed
+
+
+class MockVolumeTree:
+    """Storage volumes api of a directory tree, served through a mocked session that may be called from several
+    threads; transfers of the paths in failing always get status 500, and the first n_concurrent transfers only
+    return once they all are in flight"""
+    def __init__(self, files=None, failing=(), n_concurrent=2):
+        self.files = dict(files or {}) # path -> content
+        self.failing = set(failing)
+        self.listings = []
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.barrier = threading.Barrier(n_concurrent, timeout=10)
+        self.session = mock.Mock()
+        self.session.get.side_effect = self.get
+        self.session.put.side_effect = self.put
+
+    def parse(self, url):
+        kind, path_encoded = url.split('/v1/volumes/')[1].split('/', 1)
+        return kind, urllib.parse.unquote(path_encoded)
+
+    def transfer(self, path):
+        with self.lock:
+            self.transfers.append(path)
+            wait = len(self.transfers) <= self.barrier.parties
+        if wait:
+            self.barrier.wait() # raises BrokenBarrierError unless the transfers run concurrently
+        return path not in self.failing
+
+    def get(self, url, **kwargs):
+        kind, path = self.parse(url)
+        if kind == 'directories':
+            self.listings.append(path)
+            prefix = '' if path == '/' else path + '/'
+            names = {p[len(prefix):].split('/')[0]: '/' in p[len(prefix):] for p in self.files if p.startswith(prefix)}
+            contents = [{'path': name, 'type': 'directory' if is_dir else 'file', 'file_extension': os.path.splitext(name)[1]}
+                        for name, is_dir in names.items()]
+            return mock.Mock(status_code=200 if contents else 404, headers={},
+                             json=mock.Mock(return_value={'responseObject': {'directoryContents': contents}}))
+        if not self.transfer(path):
+            return mock.MagicMock(status_code=500, text=f'cannot read {path}', headers={})
+        res = mock.MagicMock(status_code=200)
+        res.headers = {'Content-Length': str(len(self.files[path]))}
+        res.iter_content.return_value = [self.files[path]]
+        return res
+
+    def put(self, url, data=None, **kwargs):
+        kind, path = self.parse(url)
+        body = data.read()
+        body = body[body.index(b'\r\n\r\n') + 4:body.rindex(b'\r\n--')] # the file content of the multipart body
+        if not self.transfer(path):
+            return mock.Mock(status_code=500, text=f'cannot write {path}', headers={})
+        self.files[path] = body
+        return mock.Mock(status_code=200, headers={})
+
+
+@pytest.fixture
+def volume_tree(tmp_path, monkeypatch):
+    def serve(**kwargs):
+        volume = MockVolumeTree(**kwargs)
+        monkeypatch.setattr(sv, 'get_session', lambda: volume.session)
+        monkeypatch.setattr(cpd_utils, 'get_backoff', lambda *args: 0)
+        monkeypatch.setattr(sv, 'LISTING_INDEX_DIR', str(tmp_path / 'index'))
+        monkeypatch.setattr(sv, '_listing_cache', {})
+        return volume
+    return serve
+
+
+def test_upload_batch_partial_failure(tmp_path, volume_tree):
+    volume = volume_tree(files={'out/old.png': b'old'}, failing={'out/c.png'})
+    l_path_source = []
+    for name in ['a.png', 'b.png', 'c.png', 'd.png']:
+        (tmp_path / name).write_bytes(name.encode() * 1000)
+        l_path_source.append(str(tmp_path / name))
+
+    sv.list_files('out', 'volume', access_token='token', host_url='https://host') # cached in this process
+    with pytest.raises(Exception, match='cannot write out/c.png'):
+        sv.upload_batch(l_path_source, 'out', 'volume', 'token', 'https://host', keep_source_folder_structure=False,
+                        max_workers=4)
+
+    # the target directory was listed once for all files, the other files were uploaded all the same
+    assert volume.listings == ['out', '/']
+    assert {p: volume.files[p] for p in ['out/a.png', 'out/b.png', 'out/d.png']} == \
+        {f'out/{name}': name.encode() * 1000 for name in ['a.png', 'b.png', 'd.png']}
+    assert 'out/c.png' not in volume.files
+    assert volume.transfers.count('out/c.png') == 5 # retried, without retrying the others
+    assert len(volume.transfers) == 8
+    # the listing cached before the upload is outdated even though the batch failed
+    assert sorted(m['path'] for m in sv.list_files('out', 'volume', access_token='token', host_url='https://host')) == \
+        ['a.png', 'b.png', 'd.png', 'old.png']
+
+
+def test_download_batch_partial_failure(tmp_path, volume_tree):
+    files = {'data/a.png': b'a' * 5000, 'data/b.png': b'b' * 5000, 'data/c.png': b'c' * 5000, 'other/d.png': b'd' * 5000}
+    volume = volume_tree(files=files, failing={'data/b.png'})
+
+    with pytest.raises(Exception, match='cannot read data/b.png'):
+        sv.download_batch(list(files), str(tmp_path), 'volume', access_token='token', host_url='https://host',
+                          max_workers=4)
+
+    # one listing per parent directory, shared by the paths in it
+    assert sorted(volume.listings) == ['data', 'other']
+    for path in ['data/a.png', 'data/c.png', 'other/d.png']:
+        assert (tmp_path / path).read_bytes() == files[path]
+    assert sorted(os.listdir(tmp_path / 'data')) == ['a.png', 'c.png'] # no partial file left of b.png
+    assert volume.transfers.count('data/b.png') == 5
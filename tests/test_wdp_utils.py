@@ -0,0 +1,35 @@
+from unittest import mock
+
+import pytest
+
+import wdp_utils
+
+
+def mock_session(status_code, chunks=(), body=None):
+    res = mock.Mock(status_code=status_code)
+    res.iter_content.return_value = iter(chunks)
+    res.json.return_value = body
+    session = mock.Mock()
+    session.get.return_value = res
+    return session
+
+
+def test_download_file_writes_chunks(tmp_path, monkeypatch):
+    session = mock_session(200, chunks=[b'abc', b'', b'def'])
+    monkeypatch.setattr(wdp_utils, 'get_session', lambda: session)
+
+    path = tmp_path / 'out.bin'
+    assert wdp_utils.download_file('https://host/v2/asset_files/a.bin', {'Authorization': 'x'}, str(path)) == str(path)
+    assert path.read_bytes() == b'abcdef'
+    session.get.assert_called_once_with('https://host/v2/asset_files/a.bin', stream=True,
+                                        headers={'Authorization': 'x'}, verify=False)
+
+
+def test_download_file_not_found(tmp_path, monkeypatch):
+    session = mock_session(404, body={'error': 'not_found', 'reason': 'no such asset'})
+    monkeypatch.setattr(wdp_utils, 'get_session', lambda: session)
+
+    path = tmp_path / 'out.bin'
+    with pytest.raises(Exception, match='FileNotFound: error not_found, reason no such asset'):
+        wdp_utils.download_file('https://host/v2/asset_files/a.bin', {}, str(path))
+    assert not path.exists()
@@ -0,0 +1,106 @@
+import glob
+import os
+import threading
+import urllib.parse
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+import wmla_edi_utils as edi
+
+
+def write_result(output_dir, value):
+    os.makedirs(output_dir, exist_ok=True)
+    Image.fromarray(np.full((8, 8, 3), value, dtype=np.uint8)).save(os.path.join(output_dir, 'a_Seg.png'))
+    with open(os.path.join(output_dir, 'a.json'), 'w') as f:
+        f.write(f'{{"value": {value}}}')
+
+
+def read_result(output_dir):
+    with open(os.path.join(output_dir, 'a.json')) as f:
+        return np.asarray(Image.open(os.path.join(output_dir, 'a_Seg.png')))[0, 0, 0], f.read()
+
+
+def test_result_cache_hit_is_not_changed_by_later_writes(tmp_path):
+    cache_dir, output_dir = str(tmp_path / 'cache'), str(tmp_path / 'output')
+    write_result(output_dir, 1)
+    assert edi.result_cache_put(cache_dir, 'key1', output_dir)
+
+    assert edi.result_cache_get(cache_dir, 'key1', output_dir)
+    # a later request for another image misses the cache and writes to the same output_dir
+    write_result(output_dir, 2)
+
+    other_dir = str(tmp_path / 'other')
+    assert edi.result_cache_get(cache_dir, 'key1', other_dir)
+    assert read_result(other_dir) == (1, '{"value": 1}')
+
+
+def test_result_cache_miss(tmp_path):
+    output_dir = str(tmp_path / 'output')
+    assert not edi.result_cache_get(str(tmp_path / 'cache'), 'missing', output_dir)
+    assert os.listdir(output_dir) == []
+
+
+def test_log_shipper_writes_each_line_once(tmp_path, monkeypatch):
+    uploaded = []
+    monkeypatch.setattr(edi.sv, 'upload', lambda path, **kwargs: uploaded.append(path))
+    shipper = edi.LogShipper(flush_interval=3600, flush_size=1 << 30, segment_size=4096)
+    path_source = str(tmp_path / 'kernel.log')
+
+    def write(thread):
+        for i in range(200):
+            shipper.write(path_source, [f'{thread}-{i}'])
+
+    threads = [threading.Thread(target=write, args=(t,)) for t in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert shipper.size_pending == sum(len(f'{t}-{i}\n') for t in range(4) for i in range(200))
+
+    shipper.flush()
+    assert shipper.size_pending == 0 and shipper.pending == {}
+    assert not os.path.exists(path_source)
+    segments = sorted(glob.glob(str(tmp_path / 'kernel.*.log')))
+    assert len(segments) > 1 and sorted(uploaded) == segments
+    lines = [line for path in segments for line in open(path).read().splitlines()]
+    assert sorted(lines) == sorted(f'{t}-{i}' for t in range(4) for i in range(200))
+
+
+def test_log_shipper_retries_failed_upload(tmp_path, monkeypatch):
+    def upload(path, **kwargs):
+        raise Exception('FAILED: upload')
+    monkeypatch.setattr(edi.sv, 'upload', upload)
+    shipper = edi.LogShipper(flush_interval=3600)
+    shipper.write(str(tmp_path / 'kernel.log'), ['a'], 'token', 'volume')
+    shipper.flush()
+    assert list(shipper.pending.values()) == [('token', 'volume')]
+
+
+def test_log_shipper_uploads_segment_without_listing(tmp_path, monkeypatch):
+    session = mock.Mock()
+    session.put.return_value = mock.Mock(status_code=200, headers={})
+    monkeypatch.setattr(edi.sv, 'get_session', lambda: session)
+    monkeypatch.setattr(edi.sv, 'LISTING_INDEX_DIR', str(tmp_path / 'index'))
+    shipper = edi.LogShipper(flush_interval=3600)
+    shipper.write(str(tmp_path / 'kernel.log'), ['a'], 'token', 'volume')
+    shipper.write(str(tmp_path / 'kernel.log'), ['b'], 'token', 'volume')
+    shipper.flush()
+
+    session.get.assert_not_called()
+    assert session.put.call_count == 1
+    url = urllib.parse.unquote(session.put.call_args.args[0])
+    assert url.endswith(f'/volumes/files/{glob.glob(str(tmp_path / "kernel.*.000.log"))[0]}')
+
+
+def test_result_cache_key_covers_model_settings(tmp_path):
+    input_dir = str(tmp_path / 'input')
+    write_result(input_dir, 1)
+    key = edi.result_cache_key(input_dir, 512, 'model.zip', 'fp32', 'torchscript', {'G1': 'G1.pt|None|10|1'})
+    assert key == edi.result_cache_key(input_dir, 512, 'model.zip', 'fp32', 'torchscript', {'G1': 'G1.pt|None|10|1'})
+    assert len({key,
+                edi.result_cache_key(input_dir, 512, 'model.zip', 'int8', 'torchscript', {'G1': 'G1.pt|None|10|1'}),
+                edi.result_cache_key(input_dir, 512, 'model.zip', 'fp32', 'onnxruntime', {'G1': 'G1.pt|None|10|1'}),
+                edi.result_cache_key(input_dir, 512, 'model.zip', 'fp32', 'torchscript', {'G1': 'G1.optimized.pt|None|10|1'}),
+                edi.result_cache_key(input_dir, 512, 'model.zip', 'fp32', 'torchscript', {'G1': 'G1.pt|None|10|2'})}) == 5
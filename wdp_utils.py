@@ -3,6 +3,7 @@ import mimetypes
 import json
 import os
 from tqdm import tqdm
+from cpd_utils import get_session
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -259,7 +260,7 @@ def infer_suffix(space_id,project_id,catalog_id,global_search=False):
             return f'+AND+entity.assets.catalog_id:{catalog_id}'
     
 def get(url,headers,return_json=True,return_response=False):
-    res = requests.get(url,headers=headers,verify=False)
+    res = get_session().get(url,headers=headers,verify=False)
     if return_json and not return_response:
         return res.json()
     if return_response:
@@ -267,7 +268,7 @@ def get(url,headers,return_json=True,return_response=False):
     return res.text
 
 def post(url,headers,data,return_json=True,return_response=False):
-    res = requests.post(url,headers=headers,data=json.dumps(data),verify=False)
+    res = get_session().post(url,headers=headers,data=json.dumps(data),verify=False)
     if return_json and not return_response:
         return res.json()
     if return_response:
@@ -275,7 +276,7 @@ def post(url,headers,data,return_json=True,return_response=False):
     return res.text
 
 def put(url,headers,file,return_json=True,return_response=False):
-    res = requests.put(url,headers=headers,files=file,verify=False)
+    res = get_session().put(url,headers=headers,files=file,verify=False)
     if return_json and not return_response:
         return res.json()
     if return_response:
@@ -283,7 +284,7 @@ def put(url,headers,file,return_json=True,return_response=False):
     return res.text
 
 def delete(url,headers,return_json=True,return_response=False):
-    res = requests.delete(url,headers=headers,verify=False)
+    res = get_session().delete(url,headers=headers,verify=False)
     if return_json and not return_response:
         return res.json()
     if return_response:
@@ -293,10 +294,10 @@ def delete(url,headers,return_json=True,return_response=False):
 def download_file(url,headers,local_filename=None):
     if local_filename is None:
         local_filename = url.split('/')[-1] if '?' not in url.split('/')[-1] else url.split('?')[-1]
+    res = get_session().get(url,stream=True,headers=headers,verify=False)
+    if res.status_code == 404:
+        raise Exception(f"FileNotFound: error {res.json()['error']}, reason {res.json()['reason']}")
     with open(local_filename,'wb') as f:
-        res = requests.get(url,stream=True,headers=headers,verify=False)
-        if r.status_code == 404:
-            raise exception(f"FileNotFound: error {res.json()['error']}, reason {res.json()['reason']}")
         for chunk in tqdm(res.iter_content(chunk_size=1024)):
             if chunk:
                 f.write(chunk)
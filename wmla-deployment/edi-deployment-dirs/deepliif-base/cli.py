@@ -10,8 +10,9 @@ import numpy as np
 from PIL import Image
 
 from deepliif.data import create_dataset, AlignedDataset, transform
-from deepliif.models import inference, postprocess, compute_overlap, init_nets, DeepLIIFModel
-from deepliif.util import allowed_file, Visualizer
+from deepliif.models import inference, inference_streaming, postprocess, compute_overlap, init_nets, DeepLIIFModel, \
+    run_tiles, TwoStageExecutor, prepare_batching, compute_batch_size, create_postprocess_executor
+from deepliif.util import allowed_file, open_image_lazy, TiffPageArray, Visualizer, generate_tiles
 
 import torch.distributed as dist
 
@@ -420,17 +421,69 @@ def trainlaunch(**kwargs):
 
 
 
+def init_inference(executor, precision='fp32', backend='torchscript', intra_op_threads=None, inter_op_threads=None):
+    """
+    executor: 'dask' or 'two-stage'
+    precision: 'fp32', or 'int8' / 'bf16' for the quantized nets written by the quantize command
+    backend: 'torchscript', or 'onnxruntime' for the nets written by the export-onnx command
+    intra_op_threads, inter_op_threads: thread settings of the onnxruntime backend
+
+    Returns the nets (None if they are left to be loaded by inference) and the TwoStageExecutor to pass
+    to inference (None for dask).
+    """
+    nets = None
+    if executor == 'two-stage' or precision != 'fp32' or backend != 'torchscript':
+        nets = init_nets(os.getenv('DEEPLIIF_MODEL_DIR', './model-server/DeepLIIF_Latest_Model/'), eager_mode=False,
+                         precision=precision, backend=backend,
+                         intra_op_num_threads=intra_op_threads, inter_op_num_threads=inter_op_threads)
+    if executor == 'two-stage':
+        return nets, TwoStageExecutor(nets)
+    return nets, None
+
+
+def init_batching(batch_size, max_batch_memory=None, nets=None):
+    """
+    Resolve the effective batch size once, see prepare_batching, and report when the nets cannot be batched.
+
+    Returns the nets and the batch size to pass to inference.
+    """
+    nets, effective_batch_size = prepare_batching(batch_size, max_batch_memory, nets)
+    if effective_batch_size < compute_batch_size(batch_size, max_batch_memory):
+        click.echo('The nets are in training mode, running tiles one by one to keep BatchNorm statistics per tile; '
+                   'batching needs the eval-mode variants of `serialize --optimize`')
+    return nets, effective_batch_size
+
+
 @cli.command()
 @click.option('--input-dir', default='./Sample_Large_Tissues/', help='reads images from here')
 @click.option('--output-dir', help='saves results here.')
 @click.option('--tile-size', default=512, help='tile size')
-def test(input_dir, output_dir, tile_size):
+@click.option('--batch-size', default=1, help='number of tiles stacked into one forward pass per network')
+@click.option('--max-batch-memory', type=int, default=None,
+              help='memory cap in MB for one batched forward pass; lowers the effective batch size if needed')
+@click.option('--postprocess-workers', default=1,
+              help='number of processes for tile-parallel postprocessing; 1 postprocesses the whole image at once')
+@click.option('--executor', type=click.Choice(['dask', 'two-stage']), default='dask',
+              help='how to run the nets: dask graphs per batch, or the pipelined two-stage executor')
+@click.option('--precision', type=click.Choice(['fp32', 'int8', 'bf16']), default='fp32',
+              help='run the nets written by serialize (fp32) or their quantized variants written by quantize, on CPU')
+@click.option('--backend', type=click.Choice(['torchscript', 'onnxruntime']), default='torchscript',
+              help='run the TorchScript nets, or the nets written by export-onnx with onnxruntime on CPU')
+@click.option('--intra-op-threads', type=int, default=None, help='onnxruntime threads within an operator')
+@click.option('--inter-op-threads', type=int, default=None, help='onnxruntime threads across independent operators')
+def test(input_dir, output_dir, tile_size, batch_size, max_batch_memory, postprocess_workers, executor, precision,
+         backend, intra_op_threads, inter_op_threads):
     """Test trained models
     """
     output_dir = output_dir or input_dir
     ensure_exists(output_dir)
 
+    nets, executor = init_inference(executor, precision, backend, intra_op_threads, inter_op_threads)
+    nets, batch_size = init_batching(batch_size, max_batch_memory, nets)
+
     image_files = [fn for fn in os.listdir(input_dir) if allowed_file(fn)]
+    # one process pool for tile-parallel postprocessing, reused for all images
+    postprocess_executor = create_postprocess_executor(postprocess_workers) if postprocess_workers > 1 else None
 
     with click.progressbar(
             image_files,
@@ -443,10 +496,14 @@ def test(input_dir, output_dir, tile_size):
             images = inference(
                 img,
                 tile_size=tile_size,
-                overlap_size=compute_overlap(img.size, tile_size)
+                overlap_size=compute_overlap(img.size, tile_size),
+                nets=nets,
+                batch_size=batch_size,
+                max_batch_memory=max_batch_memory,
+                executor=executor
             )
 
-            post_images, scoring = postprocess(img, images['Seg'])
+            post_images, scoring = postprocess(img, images['Seg'], tile_size=tile_size, executor=postprocess_executor)
             images = {**images, **post_images}
 
             for name, i in images.items():
@@ -461,16 +518,92 @@ def test(input_dir, output_dir, tile_size):
             ), 'w') as f:
                 json.dump(scoring, f, indent=2)
 
+    if postprocess_executor is not None:
+        postprocess_executor.shutdown()
+
+
+@cli.command()
+@click.option('--input-dir', required=True, help='reads whole-slide images (.npy, or .tif/.tiff: tiled, stripped or compressed) from here')
+@click.option('--output-dir', help='saves results here.')
+@click.option('--tile-size', default=512, help='tile size')
+@click.option('--batch-size', default=1, help='number of tiles stacked into one forward pass per network')
+@click.option('--max-batch-memory', type=int, default=None,
+              help='memory cap in MB for one batched forward pass; lowers the effective batch size if needed')
+@click.option('--executor', type=click.Choice(['dask', 'two-stage']), default='dask',
+              help='how to run the nets: dask graphs per batch, or the pipelined two-stage executor')
+@click.option('--precision', type=click.Choice(['fp32', 'int8', 'bf16']), default='fp32',
+              help='run the nets written by serialize (fp32) or their quantized variants written by quantize, on CPU')
+@click.option('--backend', type=click.Choice(['torchscript', 'onnxruntime']), default='torchscript',
+              help='run the TorchScript nets, or the nets written by export-onnx with onnxruntime on CPU')
+@click.option('--intra-op-threads', type=int, default=None, help='onnxruntime threads within an operator')
+@click.option('--inter-op-threads', type=int, default=None, help='onnxruntime threads across independent operators')
+def test_wsi(input_dir, output_dir, tile_size, batch_size, max_batch_memory, executor, precision,
+             backend, intra_op_threads, inter_op_threads):
+    """Test trained models on whole-slide images without loading them into memory
+
+    Tiles are read lazily from a memory-mapped input (or, for a tiled or compressed .tif/.tiff,
+    by decoding only the TIFF tiles or strips they overlap) and every modality is written
+    tile by tile to a memory-mapped <image name>_<modality>.npy file.
+    """
+    output_dir = output_dir or input_dir
+    ensure_exists(output_dir)
+
+    image_files = [fn for fn in os.listdir(input_dir) if os.path.splitext(fn)[1] in ['.npy', '.tif', '.tiff']]
+    nets, executor = init_inference(executor, precision, backend, intra_op_threads, inter_op_threads)
+    nets, batch_size = init_batching(batch_size, max_batch_memory, nets)
+
+    with click.progressbar(
+            image_files,
+            label=f'Processing {len(image_files)} images',
+            item_show_func=lambda fn: fn
+    ) as bar:
+        for filename in bar:
+            img = open_image_lazy(os.path.join(input_dir, filename))
+            try:
+                inference_streaming(
+                    img,
+                    output_prefix=os.path.join(output_dir, os.path.splitext(filename)[0]),
+                    tile_size=tile_size,
+                    overlap_size=compute_overlap((img.shape[1], img.shape[0]), tile_size),
+                    nets=nets,
+                    batch_size=batch_size,
+                    max_batch_memory=max_batch_memory,
+                    executor=executor
+                )
+            finally:
+                if isinstance(img, TiffPageArray): # holds the TIFF file open; a memory map is released with the array
+                    img.close()
+
 
 @cli.command()
 @click.option('--models-dir', default='./model-server/DeepLIIF_Latest_Model', help='reads models from here')
 @click.option('--output-dir', help='saves results here.')
-def serialize(models_dir, output_dir):
+@click.option('--optimize/--no-optimize', default=False,
+              help='also save frozen variants (<net>.optimized.pt), traced in eval mode and optimized for inference when '
+                   'loaded; init_nets prefers them, which changes the outputs if <net>.pt is traced in training mode')
+@click.option('--fuse-conv-bn', is_flag=True, help='fold BatchNorm layers into the preceding convolutions of the optimized variants')
+def serialize(models_dir, output_dir, optimize, fuse_conv_bn):
     """Serialize DeepLIIF models using Torchscript
+
+    <net>.pt is traced from the nets as loaded. With --optimize, <net>.optimized.pt is traced from the
+    nets in eval mode (BatchNorm running statistics, no dropout) and frozen; init_nets prefers these
+    when the torch version and device type match, and applies torch.jit.optimize_for_inference after
+    loading (its output cannot be saved). Both are listed, with the traced input shape, in manifest.json.
+
+    The nets are loaded in training mode, so <net>.pt normalizes with the statistics of each tile and
+    applies dropout. Switching to the optimized variants therefore changes the outputs, not only the
+    latency: the manifest records their largest deviation from <net>.pt on a random batch
+    (max_abs_diff_torchscript, over a few runs as dropout makes <net>.pt nondeterministic) next to
+    the one from the eager nets in eval mode (max_abs_diff). Check it before deploying.
     """
+    from copy import deepcopy
+    from deepliif.models.networks import fuse_conv_bn as fuse
+
     output_dir = output_dir or models_dir
 
     sample = transform(Image.new('RGB', (512, 512)))
+    manifest = {'input_shape': list(sample.shape), 'torch_version': torch.__version__, 'nets': {}}
+    drift = []
 
     with click.progressbar(
             init_nets(models_dir, eager_mode=True).items(),
@@ -478,8 +611,295 @@ def serialize(models_dir, output_dir):
             item_show_func=lambda n: n[0] if n else n
     ) as bar:
         for name, net in bar:
+            # copy before tracing: a trace in training mode updates the BatchNorm running statistics
+            net_eval = deepcopy(net).eval() if optimize else None
+
             traced_net = torch.jit.trace(net, sample)
             traced_net.save(f'{output_dir}/{name}.pt')
+            manifest['nets'][name] = {'torchscript': f'{name}.pt', 'torchscript_training': traced_net.training}
+
+            if optimize:
+                if fuse_conv_bn:
+                    fuse(net_eval)
+                device = next(net_eval.parameters()).device
+                sample_device = sample.to(device)
+                with torch.no_grad():
+                    frozen_net = torch.jit.freeze(torch.jit.trace(net_eval, sample_device))
+                    frozen_net.save(f'{output_dir}/{name}.optimized.pt')
+                    optimized_net = torch.jit.optimize_for_inference(frozen_net)
+                    max_abs_diff = (optimized_net(sample_device) - net_eval(sample_device)).abs().max().item()
+
+                    # deviation from the <net>.pt deployed so far, on a random batch
+                    x = torch.rand(2, *sample.shape[1:], device=device) * 2 - 1
+                    y = optimized_net(x)
+                    max_abs_diff_torchscript = max((y - traced_net(x)).abs().max().item() for _ in range(3))
+                manifest['nets'][name].update({'optimized': f'{name}.optimized.pt',
+                                               'optimize_for_inference': True,
+                                               'device': device.type,
+                                               'fused_conv_bn': fuse_conv_bn,
+                                               'max_abs_diff': max_abs_diff,
+                                               'max_abs_diff_torchscript': max_abs_diff_torchscript})
+                drift.append(f'{name} {max_abs_diff_torchscript:.2e}')
+
+    with open(f'{output_dir}/manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if drift:
+        click.echo(f'init_nets will load the optimized variants, largest deviation from <net>.pt: {", ".join(drift)}')
+
+
+@cli.command()
+@click.option('--models-dir', default='./model-server/DeepLIIF_Latest_Model', help='reads models from here')
+@click.option('--output-dir', help='saves results here.')
+@click.option('--opset', default=13, help='ONNX opset version to export to')
+@click.option('--tolerance', default=1e-4, help='largest absolute difference to TorchScript allowed by the parity check')
+def export_onnx(models_dir, output_dir, opset, tolerance):
+    """Export DeepLIIF models to ONNX for the onnxruntime backend
+
+    The nets are exported from the eager nets in eval mode, with a dynamic batch dimension, as
+    <net>.onnx. Each export is then checked for parity: onnxruntime and the TorchScript net traced
+    from the same eager net are run on a random batch, and only exports whose outputs stay within
+    the tolerance are listed in manifest.json, which init_nets requires for the onnxruntime backend.
+    """
+    from deepliif.models import load_onnx_model
+
+    output_dir = output_dir or models_dir
+
+    sample = transform(Image.new('RGB', (512, 512)))
+    path_manifest = f'{output_dir}/manifest.json'
+    manifest = {'input_shape': list(sample.shape), 'torch_version': torch.__version__, 'nets': {}}
+    if os.path.exists(path_manifest):
+        with open(path_manifest) as f:
+            manifest = json.load(f)
+
+    failed = []
+    nets = init_nets(models_dir, eager_mode=True)
+    with click.progressbar(
+            list(nets),
+            label='Exporting nets',
+            item_show_func=lambda n: n
+    ) as bar:
+        for name in bar:
+            net_eval = nets.pop(name).cpu().eval() # released once exported, to bound memory
+            kwargs = dict(input_names=['input'], output_names=['output'], opset_version=opset,
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+            with torch.no_grad():
+                try:
+                    torch.onnx.export(net_eval, sample, f'{output_dir}/{name}.onnx', dynamo=False, **kwargs)
+                except TypeError: # torch < 2.5 has no dynamo exporter to opt out of
+                    torch.onnx.export(net_eval, sample, f'{output_dir}/{name}.onnx', **kwargs)
+
+                # parity check against TorchScript, with a batch size other than the exported one
+                traced_net = torch.jit.trace(net_eval, sample)
+                onnx_net = load_onnx_model(f'{output_dir}/{name}.onnx')
+                x = torch.rand(2, *sample.shape[1:]) * 2 - 1
+                max_abs_diff = (onnx_net(x) - traced_net(x)).abs().max().item()
+
+            entry = manifest['nets'].setdefault(name, {'torchscript': f'{name}.pt'})
+            entry['onnx_max_abs_diff'] = max_abs_diff
+            if max_abs_diff <= tolerance:
+                entry['onnx'] = f'{name}.onnx'
+            else:
+                entry.pop('onnx', None)
+                failed.append(f'{name} ({max_abs_diff:.2e})')
+
+    with open(path_manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if failed:
+        click.echo(f'Parity check failed, not listed in manifest.json: {", ".join(failed)}')
+    else:
+        click.echo(f'Parity check passed for all nets (tolerance {tolerance})')
+
+
+@cli.command()
+@click.option('--models-dir', default='./model-server/DeepLIIF_Latest_Model', help='reads models from here')
+@click.option('--output-dir', help='saves the quantized models and the report here, defaults to models-dir')
+@click.option('--calibration-dir', required=True, help='reads sample images to calibrate on and to compare with fp32 from here')
+@click.option('--precision', type=click.Choice(['int8', 'bf16']), default='int8', help='precision to quantize to')
+@click.option('--tile-size', default=512, help='tile size')
+@click.option('--calibration-tiles', default=32, help='maximum number of tiles to calibrate on')
+def quantize(models_dir, output_dir, calibration_dir, precision, tile_size, calibration_tiles):
+    """Quantize DeepLIIF models for CPU inference and report the drift against fp32
+
+    The nets are quantized from the eager nets in eval mode: int8 quantizes weights and activations with
+    ranges observed on tiles of the images in calibration-dir, bf16 casts them to bfloat16. They are saved
+    as <net>.<precision>.pt and listed in manifest.json, to be run with `test --precision <precision>`.
+
+    Every image in calibration-dir is then run through inference and postprocessing with the fp32 and the
+    quantized nets; the mean and max absolute pixel error per modality and the drift of the IHC scoring
+    are saved to quantize_report_<precision>.json. The quantized nets are compared with two references:
+    the eager nets in eval mode they were quantized from (pixel_error, drift), and the fp32 nets the
+    deployment runs, as loaded by init_nets (pixel_error_deployed, drift_deployed). <net>.pt is traced in
+    training mode, so only the latter includes the change from per-tile to running BatchNorm statistics
+    and the removal of dropout, i.e., what actually changes when switching DEEPLIIF_PRECISION.
+    """
+    from copy import deepcopy
+    from deepliif.models import quantize_net
+
+    output_dir = output_dir or models_dir
+    ensure_exists(output_dir)
+    image_files = sorted(fn for fn in os.listdir(calibration_dir) if allowed_file(fn))
+
+    # init_nets is cached, so the shared eager nets are not modified in place; the cache is then cleared
+    # to release them, as the eager, the deployed and the quantized nets are all held at once below
+    nets = {n: deepcopy(net).cpu().eval() for n, net in init_nets(models_dir, eager_mode=True).items()}
+    init_nets.cache_clear()
+
+    # calibration inputs: tiles of the sample images, and the fp32 outputs of G1-G4 for the segmentation nets
+    ts = []
+    for filename in image_files:
+        img = Image.open(os.path.join(calibration_dir, filename))
+        ts += [transform(t.img.resize((512, 512))) for t in generate_tiles(img, tile_size, compute_overlap(img.size, tile_size))]
+    ts = ts[:calibration_tiles]
+    calibration_inputs = {n: ts for n in ['G1', 'G2', 'G3', 'G4', 'G51']}
+    with torch.no_grad():
+        for k, v in TwoStageExecutor.seg_map.items():
+            calibration_inputs[v] = [nets[k](x) for x in ts]
+
+    quantized_nets = {}
+    with click.progressbar(
+            nets.items(),
+            label=f'Quantizing nets to {precision}',
+            item_show_func=lambda n: n[0] if n else n
+    ) as bar:
+        for name, net in bar:
+            quantized_nets[name] = quantize_net(net, precision, calibration_inputs[name])
+            quantized_nets[name].save(f'{output_dir}/{name}.{precision}.pt')
+
+    path_manifest = f'{output_dir}/manifest.json'
+    manifest = {'input_shape': list(ts[0].shape), 'torch_version': torch.__version__, 'nets': {}}
+    if os.path.exists(path_manifest):
+        with open(path_manifest) as f:
+            manifest = json.load(f)
+    for name in nets:
+        manifest['nets'].setdefault(name, {'torchscript': f'{name}.pt'})[precision] = f'{name}.{precision}.pt'
+    with open(path_manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    deployed_nets = init_nets(models_dir)
+    report = {'precision': precision, 'images': {}}
+    with click.progressbar(
+            image_files,
+            label=f'Comparing {len(image_files)} images with fp32',
+            item_show_func=lambda fn: fn
+    ) as bar:
+        for filename in bar:
+            img = Image.open(os.path.join(calibration_dir, filename))
+            res = {}
+            for p, n in [('fp32', nets), ('deployed', deployed_nets), (precision, quantized_nets)]:
+                images = inference(img, tile_size=tile_size, overlap_size=compute_overlap(img.size, tile_size), nets=n)
+                post_images, scoring = postprocess(img, images['Seg'], tile_size=tile_size)
+                res[p] = ({**images, **post_images}, scoring)
+
+            images_q, scoring_q = res[precision]
+
+            def pixel_error(images_ref):
+                error = {}
+                for name in images_ref:
+                    e = np.abs(np.array(images_ref[name], dtype=np.int16) - np.array(images_q[name], dtype=np.int16))
+                    error[name] = {'mean': float(e.mean()), 'max': int(e.max())}
+                return error
+
+            (images_fp32, scoring_fp32), (images_deployed, scoring_deployed) = res['fp32'], res['deployed']
+            report['images'][filename] = {
+                'pixel_error': pixel_error(images_fp32),
+                'pixel_error_deployed': pixel_error(images_deployed),
+                'scoring': {k: {'fp32': scoring_fp32[k], 'deployed': scoring_deployed[k], precision: scoring_q[k],
+                                'drift': scoring_q[k] - scoring_fp32[k],
+                                'drift_deployed': scoring_q[k] - scoring_deployed[k]}
+                            for k in scoring_fp32}
+            }
+
+    with open(f'{output_dir}/quantize_report_{precision}.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for key, reference in [('', 'eval-mode fp32'), ('_deployed', 'deployed fp32')]:
+        click.echo(f'Against the {reference} nets:')
+        for name in (report['images'][image_files[0]]['pixel_error'] if image_files else []):
+            errors = [r[f'pixel_error{key}'][name] for r in report['images'].values()]
+            click.echo(f'  {name}: mean abs pixel error {sum(e["mean"] for e in errors) / len(errors):.3f}, '
+                       f'max {max(e["max"] for e in errors)}')
+        for k in ['num_total', 'num_pos', 'num_neg', 'percent_pos']:
+            drifts = [abs(r['scoring'][k][f'drift{key}']) for r in report['images'].values()]
+            if drifts:
+                click.echo(f'  {k}: max abs drift {max(drifts)}')
+
+
+@cli.command()
+@click.option('--sizes', type=int, multiple=True, default=[512, 2048, 8192], help='image sizes in px to benchmark')
+@click.option('--repeat', default=3, help='number of timed runs per size')
+def benchmark_postprocess(sizes, repeat):
+    """Time the flood-fill postprocessing steps on synthetic masks
+
+    compute_cell_mapping and remove_noises are timed on random blob masks of each size;
+    the numba compilation on the first call is not included.
+    """
+    from deepliif.postprocessing import compute_cell_mapping, remove_noises
+
+    rng = np.random.default_rng(0)
+
+    def blobs(size):
+        noise = cv2.GaussianBlur(rng.random((size, size)).astype(np.float32), (0, 0), 2)
+        return ((noise > np.quantile(noise, 0.7)) * 255).astype(np.uint8)
+
+    warm_up = np.zeros((16, 16, 3), dtype=np.uint8)
+    compute_cell_mapping(warm_up, warm_up.shape, 50)
+    remove_noises(warm_up[:, :, 0].copy(), warm_up.shape[:2], 50)
+
+    for size in sizes:
+        cell_mapping = np.zeros((size, size, 3), dtype=np.uint8)
+        cell_mapping[:, :, 0] = blobs(size)
+        cell_mapping[:, :, 2] = blobs(size)
+        cell_mapping[:, :, 2][cell_mapping[:, :, 0] > 0] = 0
+        channel = 255 - cell_mapping[:, :, 0]
+
+        timings = {'compute_cell_mapping': [], 'remove_noises': []}
+        for _ in range(repeat):
+            t_s = time.time()
+            compute_cell_mapping(cell_mapping.copy(), cell_mapping.shape, 50)
+            timings['compute_cell_mapping'].append(time.time() - t_s)
+
+            t_s = time.time()
+            remove_noises(channel.copy(), channel.shape, 200)
+            timings['remove_noises'].append(time.time() - t_s)
+
+        for name, t in timings.items():
+            click.echo(f'{size}px {name}: best {min(t):.4f}s, mean {sum(t) / len(t):.4f}s')
+
+
+@cli.command()
+@click.option('--models-dir', default='./model-server/DeepLIIF_Latest_Model', help='reads models from here')
+@click.option('--tiles', default=32, help='number of synthetic 512x512 tiles per run')
+@click.option('--batch-size', default=1, help='number of tiles stacked into one forward pass per network')
+@click.option('--repeat', default=3, help='number of timed runs per executor')
+def benchmark_executor(models_dir, tiles, batch_size, repeat):
+    """Time the dask graphs against the two-stage executor on synthetic tiles
+
+    Both executors run the same nets on the same tiles; the outputs are compared and the first
+    (warm-up) run of each executor is not included.
+    """
+    from deepliif.util import Tile
+
+    rng = np.random.default_rng(0)
+    tiles = [Tile(0, k, Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8))) for k in range(tiles)]
+    nets, batch_size = init_batching(batch_size, nets=init_nets(models_dir, eager_mode=False))
+    executors = {'dask': None, 'two-stage': TwoStageExecutor(nets)}
+
+    res = {}
+    for name, executor in executors.items():
+        res[name] = run_tiles(tiles, nets=nets, batch_size=batch_size, executor=executor)
+        t = []
+        for _ in range(repeat):
+            t_s = time.time()
+            run_tiles(tiles, nets=nets, batch_size=batch_size, executor=executor)
+            t.append(time.time() - t_s)
+        click.echo(f'{name}: best {min(t):.4f}s, mean {sum(t) / len(t):.4f}s, {len(tiles) / min(t):.1f} tiles/s')
+    executors['two-stage'].close()
+
+    same = all(np.array_equal(np.array(a.img[k]), np.array(b.img[k]))
+               for a, b in zip(res['dask'], res['two-stage']) for k in a.img)
+    click.echo(f'outputs identical: {same}')
 
 
 @cli.command()
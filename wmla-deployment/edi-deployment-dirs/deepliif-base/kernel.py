@@ -11,10 +11,7 @@ import os
 import subprocess
 import sys
 import pickle
-import pkg_resources
-from packaging import version
 import urllib3
-from zipfile import ZipFile
 import uuid
 import base64
 from io import BytesIO
@@ -41,7 +38,25 @@ filename_model = os.environ['WML_SPACE_MODEL']
 dir_python_pkg = f"{dir_user}/python_packages"
 os.environ['DEEPLIIF_MODEL_DIR'] = f'{dir_user}/{os.path.splitext(filename_model)[0]}'
 os.environ['DEEPLIIF_SEED'] = 'None'
+model_checksum = os.getenv('DEEPLIIF_MODEL_CHECKSUM') # optional "<algorithm>:<hex digest>" of the model zip
+model_from_zip = os.getenv('DEEPLIIF_MODEL_FROM_ZIP', 'false').lower() == 'true' # load nets from the zip, no extraction
 os.environ['VOLUME_DISPLAY_NAME'] = VOLUME_DISPLAY_NAME
+batch_size = int(os.getenv('DEEPLIIF_BATCH_SIZE', 8)) # tiles per forward pass
+max_batch_memory = os.getenv('DEEPLIIF_MAX_BATCH_MEMORY') # optional cap in MB for one forward pass
+max_batch_memory = int(max_batch_memory) if max_batch_memory is not None else None
+batch_wait = float(os.getenv('DEEPLIIF_BATCH_WAIT_MS', 0)) # wait for tiles of concurrent requests to batch with, 0 disables
+executor_type = os.getenv('DEEPLIIF_EXECUTOR', 'dask') # 'dask', or 'two-stage' to pipeline the nets on persistent workers
+precision = os.getenv('DEEPLIIF_PRECISION', 'fp32') # 'fp32', or 'int8' / 'bf16' for the nets written by cli.py quantize
+backend = os.getenv('DEEPLIIF_BACKEND', 'torchscript') # 'torchscript', or 'onnxruntime' for the nets written by cli.py export-onnx
+ort_intra_op_threads = os.getenv('DEEPLIIF_ORT_INTRA_OP_THREADS') # optional onnxruntime thread settings
+ort_intra_op_threads = int(ort_intra_op_threads) if ort_intra_op_threads is not None else None
+ort_inter_op_threads = os.getenv('DEEPLIIF_ORT_INTER_OP_THREADS')
+ort_inter_op_threads = int(ort_inter_op_threads) if ort_inter_op_threads is not None else None
+postprocess_workers = int(os.getenv('DEEPLIIF_POSTPROCESS_WORKERS', 1)) # processes for tile-parallel postprocessing
+dir_result_cache = f'edi_deployments/{deploy_name}/result_cache'
+result_cache_max_size = float(os.getenv('DEEPLIIF_RESULT_CACHE_MAX_SIZE', 1024)) # in MB, 0 disables the cache
+result_cache_max_age = float(os.getenv('DEEPLIIF_RESULT_CACHE_MAX_AGE', 168)) # in hours since last use
+png_compress_level = int(os.getenv('DEEPLIIF_PNG_COMPRESS_LEVEL', 6)) # 0-9, lower is faster to write but larger
 os.makedirs(dir_python_pkg,exist_ok=True)
 sys.path.insert(0, dir_python_pkg)
 
@@ -62,6 +77,68 @@ image_return_dict = {'all':all_images,
                      'modalities':modality_images,
                      'seg_masks':seg_images}
 
+# image formats in response: None sends the written png files as they are
+image_formats = {'png':None,
+                 'webp':'WEBP'}
+
+
+def run_deepliif(input_dir, output_dir, tile_size, nets, batcher=None, executor=None, postprocess_executor=None):
+    """
+    In-process equivalent of `python cli.py test`: runs inference and postprocessing on every
+    image in input_dir with the networks already loaded in on_kernel_start, and writes the
+    output images and scoring json to output_dir using the same filenames as cli.py.
+    If a batcher is given, tiles are batched together with those of concurrent requests; if an
+    executor is given, the nets are run with it instead of dask. postprocess_executor is the process
+    pool for tile-parallel postprocessing created in on_kernel_start, if any.
+    """
+    from deepliif.models import inference, postprocess, compute_overlap
+    from deepliif.util import allowed_file
+
+    image_files = [fn for fn in os.listdir(input_dir) if allowed_file(fn)]
+    for filename in image_files:
+        img = Image.open(os.path.join(input_dir, filename))
+
+        images = inference(img,
+                           tile_size=tile_size,
+                           overlap_size=compute_overlap(img.size, tile_size),
+                           nets=nets,
+                           batch_size=batch_size,
+                           max_batch_memory=max_batch_memory,
+                           batcher=batcher,
+                           executor=executor)
+        post_images, scoring = postprocess(img, images['Seg'], tile_size=tile_size, executor=postprocess_executor)
+        images = {**images, **post_images}
+
+        basename = filename.replace('.' + filename.split('.')[-1], '')
+        for name, i in images.items():
+            i.save(os.path.join(output_dir, f'{basename}_{name}.png'), compress_level=png_compress_level)
+
+        with open(os.path.join(output_dir, f'{basename}.json'), 'w') as f:
+            json.dump(scoring, f, indent=2)
+
+
+def run_deepliif_cached(input_dir, output_dir, tile_size, nets, batcher=None, executor=None, postprocess_executor=None):
+    """
+    run_deepliif behind the result cache: a request whose input images, tile size, model file, precision,
+    backend and loaded net files match an earlier request gets the earlier output files copied into
+    output_dir instead of running inference again. Returns True if the result was served from the cache.
+    """
+    from deepliif.models import get_net_artifacts
+    
+    if result_cache_max_size <= 0:
+        run_deepliif(input_dir, output_dir, tile_size, nets, batcher, executor, postprocess_executor)
+        return False
+    
+    key = edi.result_cache_key(input_dir, tile_size, filename_model, precision, backend, get_net_artifacts(nets))
+    if edi.result_cache_get(dir_result_cache, key, output_dir):
+        return True
+    
+    run_deepliif(input_dir, output_dir, tile_size, nets, batcher, executor, postprocess_executor)
+    edi.result_cache_put(dir_result_cache, key, output_dir,
+                         max_size=result_cache_max_size * 1024 * 1024,
+                         max_age=result_cache_max_age * 3600)
+    return False
+
 
 class MatchKernel(Kernel):
 
@@ -75,81 +152,67 @@ class MatchKernel(Kernel):
         KERNEL_LOG_PATH = f'edi_deployments/{deploy_name}/edi_logs/{os.environ["MSD_POD_NAME"]}_inference.log'
         self.kernel_log_path = KERNEL_LOG_PATH
         
-        # -------- check and install packages: it's faster to manually check and skip installed ones --------
-        with open('requirements.txt') as f:
-            requirements = f.readlines()
-        pkgs = pkg_resources.parse_requirements(requirements)
-        dict_pkg = {i.key:i.specs for i in pkgs}
-        
+        # -------- install missing packages: once per requirements.txt content, from a shared wheelhouse --------
         print(f"Install pip dependencies to {dir_python_pkg}")
+        edi.install_requirements('requirements.txt', dir_python_pkg, f'{dir_user}/wheelhouse',
+                                 find_links=['https://download.pytorch.org/whl/torch_stable.html'])
         
-        idx_to_install = []
-        for i,(pkg_name,pkg_specs) in enumerate(dict_pkg.items()):
-            # refresh installed packages in case other kernel has installed a new package (lib path is shared)
-            installed_packages = pkg_resources.working_set
-            installed_packages = {pkg.key:pkg.version for pkg in installed_packages}
-
-            print(i,pkg_name,pkg_specs)
-            if pkg_name in installed_packages:
-                if len(pkg_specs)>0:
-                    code_compare = f"version.parse('{installed_packages[pkg_name]}') {pkg_specs[0][0]} version.parse('{pkg_specs[0][1]}')"
-                    if not eval(code_compare):
-                        print(f'{pkg_name}: wait to be installed')
-                        idx_to_install.append(i)
-                    else:
-                        print(f'{pkg_name}: already installed')
-                else:
-                    print(f'{pkg_name}: already installed')
-            else:
-                print(f'{pkg_name}: wait to be installed')
-                idx_to_install.append(i)
-
-        requirements_new = [requirements[i] for i in idx_to_install]
-        with open(f'requirements_{os.environ["MSD_POD_NAME"]}.txt','w') as f:
-            f.writelines(requirements_new)
+        # -------- provision model and deepliif code: fetched, verified and extracted once for all kernels --------
+        def fetch_model(path_target):
+            import wml_sdk_utils as wml_util
+            wml_client = (wml_util
+                          .get_client(credentials={'url':os.getenv('BASE_URL',
+                                                                   os.getenv('RUNTIME_ENV_APSX_URL',
+                                                                             'https://cpd-cpd.apps.cpd.mskcc.org')),
+                                                   'username':CPD_USERNAME,
+                                                   'apikey':CPD_API_KEY},
+                                      space_id=os.environ['WML_SPACE_ID']))
+            print("Start downloading model file")
+            if not wml_util.download(filename_model, wml_client, path_target, return_status=True):
+                raise Exception(f'FAILED: cannot download model file {filename_model} from WML space')
         
-        if len(idx_to_install)>0:
-            out = subprocess.check_output(f'pip install -r requirements_{os.environ["MSD_POD_NAME"]}.txt -f https://download.pytorch.org/whl/torch_stable.html --target={dir_python_pkg}', shell=True, text=True, stderr=subprocess.STDOUT)
-            print(out)
+        edi.provision_archive(f'{dir_user}/{filename_model}',
+                              None if model_from_zip else os.environ['DEEPLIIF_MODEL_DIR'],
+                              fetch=fetch_model, checksum=model_checksum)
+        edi.provision_archive(f'{dir_user}/deepliif.zip', f'{dir_user}/deepliif')
         
-        # -------- download model file from WML space --------
-        # WML client
-        import wml_sdk_utils as wml_util
-        wml_client = (wml_util
-                      .get_client(credentials={'url':os.getenv('BASE_URL',
-                                                               os.getenv('RUNTIME_ENV_APSX_URL',
-                                                                         'https://cpd-cpd.apps.cpd.mskcc.org')),
-                                               'username':CPD_USERNAME,
-                                               'apikey':CPD_API_KEY},
-                                  space_id=os.environ['WML_SPACE_ID']))
+        # -------- add lib paths for running cli.py in a subprocess, instead of patching cli.py --------
+        os.environ['PYTHONPATH'] = os.pathsep.join([dir_python_pkg, dir_user] +
+                                                   [p for p in os.getenv('PYTHONPATH', '').split(os.pathsep) if p])
         
-        if not os.path.exists(f'{dir_user}/{filename_model}'):
-            print("Start downloading model file")
-            t_s = datetime.now()
-            wml_util.download(filename_model, wml_client, dir_user)
-            t_e = datetime.now()
-            d = t_e - t_s
-            print(f"Model file download complete...elapsed time: {d.seconds}s {d.microseconds}ms", 
-                        self.kernel_log_path)
-
-            print("Start unzipping model file")
-            with ZipFile(filename_model, 'r') as z:
-                z.extractall(dir_user)
+        # -------- load deepliif nets once, kept resident for all requests --------
+        if dir_user not in sys.path:
+            sys.path.insert(1, dir_user)
+        from deepliif.models import init_nets
+        print('Start loading deepliif nets')
+        self.nets = init_nets(f'{dir_user}/{filename_model}' if model_from_zip else os.environ['DEEPLIIF_MODEL_DIR'],
+                              precision=precision, backend=backend,
+                              intra_op_num_threads=ort_intra_op_threads, inter_op_num_threads=ort_inter_op_threads)
+        
+        # -------- batching needs nets in eval mode, reported once instead of on every request --------
+        from deepliif.models import is_batchable, compute_batch_size
+        if compute_batch_size(batch_size, max_batch_memory) > 1 and not is_batchable(self.nets):
+            edi.log('The nets are in training mode, so DEEPLIIF_BATCH_SIZE has no effect and tiles run one by one; '
+                    'batching needs a model serialized with `cli.py serialize --optimize`',self.kernel_log_path)
         
-        # -------- unzip deepliif archive --------
-        if not os.path.exists('deepliif'):
-            # Unzip deepliif code
-            print('Start unzipping deepliif code')
-            with ZipFile('deepliif.zip', 'r') as z:
-                z.extractall('deepliif')
+        # -------- run the nets with dask graphs or the pipelined two-stage executor --------
+        self.tile_executor = None
+        if executor_type == 'two-stage':
+            from deepliif.models import TwoStageExecutor
+            self.tile_executor = TwoStageExecutor(self.nets)
         
-        # -------- add new lib path for running cli.py --------
-        with open('cli.py', 'r+') as fd:
-            contents = fd.readlines()
-            if f"import sys\nsys.path.insert(0, '{dir_python_pkg}')\n" not in contents:
-                contents.insert(0, f"import sys\nsys.path.insert(0, '{dir_python_pkg}')\n")
-                fd.seek(0)
-                fd.writelines(contents)
+        # -------- batch tiles across concurrent requests --------
+        self.batcher = None
+        if batch_wait > 0:
+            from deepliif.models import TileBatcher
+            self.batcher = TileBatcher(self.nets, compute_batch_size(batch_size, max_batch_memory), max_wait=batch_wait / 1000,
+                                       executor=self.tile_executor)
+        
+        # -------- one process pool for tile-parallel postprocessing, reused by all requests --------
+        self.postprocess_executor = None
+        if postprocess_workers > 1:
+            from deepliif.models import create_postprocess_executor
+            self.postprocess_executor = create_postprocess_executor(postprocess_workers)
         
         d = datetime.now() - t_s
         print(f"Kernel initiation complete...elapsed time: {d.seconds}s {d.microseconds}ms")
@@ -173,6 +236,7 @@ class MatchKernel(Kernel):
             request_id = str(input_data['request_id']) if 'request_id' in input_data else str(uuid.uuid4())
             tile_size = str(input_data['tile_size']) if 'tile_size' in input_data else 512
             images_to_return = str(input_data['images_to_return']) if 'images_to_return' in input_data else 'all'
+            image_format = str(input_data['image_format']).lower() if 'image_format' in input_data else 'png'
             path_source = input_data.get('img_path_on_pvc')
             local_image = input_data.get('local_input_image')
             
@@ -203,6 +267,12 @@ class MatchKernel(Kernel):
                 task_context.set_output_data(json.dumps(output_data))
                 return
             
+            if image_format not in image_formats.keys():
+                output_data['status'] = 'failed'
+                output_data['msg'] = f"Error: value for image_format ({image_format}) is not one of {list(image_formats.keys())}"
+                task_context.set_output_data(json.dumps(output_data))
+                return
+            
             # -------- run inference --------
             OUTPUT_DIR = f'edi_deployments/{deploy_name}/{request_id}/output_dir/'
             os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -232,22 +302,24 @@ class MatchKernel(Kernel):
             
             t_s = datetime.now()
 
-            cmd = (f"python cli.py test --input-dir {INPUT_DIR}/{fd} "
-                   f"--output-dir {OUTPUT_DIR} --tile-size {tile_size}")
-            out = subprocess.run(cmd, shell=True, capture_output=True, cwd=dir_user)
-            if out.returncode != 0:
+            try:
+                cache_hit = run_deepliif_cached(f'{INPUT_DIR}/{fd}', OUTPUT_DIR, tile_size, self.nets, self.batcher, self.tile_executor,
+                                                self.postprocess_executor)
+            except Exception:
+                out = traceback.format_exc()
                 print(out)
                 output_data['status'] = 'failed'
-                output_data['log'].append(str(out))
+                output_data['log'].append(out)
                 output_data['msg'] = 'Error: inference failed. Check the log field for more information.'
                 task_context.set_output_data(json.dumps(output_data))
                 return
             
             t_e = datetime.now()
             d = t_e - t_s
-            print('Images generated successfully')
+            msg_images = 'Images served from result cache' if cache_hit else 'Images generated successfully'
+            print(msg_images)
             print(f"Inference complete...elapsed time: {d.seconds}s {d.microseconds}ms")
-            output_data['log'].append('Images generated successfully')
+            output_data['log'].append(msg_images)
             output_data['log'].append(f"Inference complete...elapsed time: {d.seconds}s {d.microseconds}ms")
 
             # remove unneeded images from output dir
@@ -269,12 +341,11 @@ class MatchKernel(Kernel):
                 for _, _, files in os.walk(OUTPUT_DIR):
                     for file in files:
                         if file.endswith('.png'):
-                            img = Image.open(os.path.join(OUTPUT_DIR, file))
-                            buffer = BytesIO()
-                            img.save(buffer, 'PNG')
-                            serialized = base64.b64encode(buffer.getvalue()).decode('utf-8')
                             basename = os.path.basename(file)
-                            output_data['images'][basename] = serialized
+                            if image_format != 'png':
+                                basename = f"{os.path.splitext(basename)[0]}.{image_format}"
+                            output_data['images'][basename] = edi.serialize_image_file(os.path.join(OUTPUT_DIR, file),
+                                                                                       image_formats[image_format])
                
                 output_data['msg'] = f'{request_id}: Inference complete, output images can be found in images field.'
             else:
@@ -297,7 +368,15 @@ class MatchKernel(Kernel):
             task_context.set_output_data(json.dumps(output_data))
     
     def on_kernel_shutdown(self):
-        pass
+        if self.batcher is not None:
+            self.batcher.close()
+        if self.tile_executor is not None:
+            self.tile_executor.close()
+        if self.postprocess_executor is not None:
+            self.postprocess_executor.shutdown()
+        
+        # ship log messages still queued for the storage volume
+        edi.flush_log()
 
         
 if __name__ == '__main__':
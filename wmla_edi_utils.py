@@ -4,13 +4,25 @@ import os
 from datetime import datetime, timezone
 import storage_volume_utils as sv
 import cpd_utils as cpdu
-from typing import Union, List
+from typing import Union, List, Dict
 import subprocess
 from time import sleep
 from typing import Optional
 from PIL import Image
 from io import BytesIO
 import base64
+import hashlib
+import shutil
+import time
+import uuid
+import threading
+import atexit
+import sys
+import fcntl
+import json
+import zipfile
+from typing import Callable
+from contextlib import contextmanager
 
 if os.environ.get('REDHARE_MODEL_NAME', False):
     from redhareapi import Kernel
@@ -20,7 +32,7 @@ if os.environ.get('REDHARE_MODEL_NAME', False):
 def log(message:Union[str,List], path_source:str,
         save_log_to_volume:bool=True, access_token:str=None,
         volume_display_name:str=None) -> None:
-    """Upload a message to the log on a remote storage volume.
+    """Append a message to a local log and queue it for the log on a remote storage volume.
     
             Parameters:
                     message (str or list): String or list of strings to write to log
@@ -28,6 +40,13 @@ def log(message:Union[str,List], path_source:str,
                     save_log_to_volume (bool): Write to storage volume or only to WMLA log?
                     access_token (str): CPD access token
                     volume_display_name (str): Name of the storage volume to write to
+            
+            Notes:
+                    Messages are shipped to the storage volume in the background by a LogShipper,
+                    in batches and as rotated segment files next to path_source (see LogShipper),
+                    so this call does not wait for any HTTP request. Call flush_log() before the
+                    process exits, e.g., in on_kernel_shutdown. With save_log_to_volume, the segment
+                    files are the only local copy; path_source itself is not written.
     """
     
     if not isinstance(message,list):
@@ -45,41 +64,141 @@ def log(message:Union[str,List], path_source:str,
     message.insert(0, timestamp_str)
     message.insert(len(message), '') # double-spacing between log messages
     
+    if os.path.isdir(path_source):
+        backup_name =  os.getenv('MSD_POD_NAME','edi_inference') + '.log'
+        path_source = path_source.rstrip('/')
+        path_source = f"{path_source}/{backup_name}"
+        try:
+            Kernel.log_info(f'No filename provided for log...defaulting to {backup_name}')
+        except:
+            pass
+    
+    LOG_LOCAL_PATH = path_source
+    LOG_DIRNAME = os.path.dirname(LOG_LOCAL_PATH)
+
+    # Write to internal storage regardless, once: logs shipped to the storage volume are written as
+    # the segment files that get uploaded
+    if LOG_DIRNAME != '':
+        os.makedirs(LOG_DIRNAME, exist_ok=True)
     if save_log_to_volume:
-        volume_display_name = sv.fill_in_default_if_none(volume_display_name,
-                                                         'VOLUME_DISPLAY_NAME',
-                                                         'DeepLIIFData')
-        access_token = sv.fill_in_default_if_none(access_token,
-                                                  'USER_ACCESS_TOKEN')
-        
-        if os.path.isdir(path_source):
-            backup_name =  os.getenv('MSD_POD_NAME','edi_inference') + '.log'
-            path_source = path_source.rstrip('/')
-            path_source = f"{path_source}/{backup_name}"
+        get_log_shipper().write(LOG_LOCAL_PATH, message, access_token, volume_display_name)
+    else:
+        with open(LOG_LOCAL_PATH, 'a') as file:
+            file.writelines(f"{x}\n" for x in message)
+
+
+def flush_log(timeout: float = 60) -> None:
+    """Ship all queued log messages to the storage volume now and wait until done.
+        Args:
+            timeout: maximum number of seconds to wait
+    """
+    if _log_shipper is not None:
+        _log_shipper.flush(timeout)
+
+
+class LogShipper:
+    """Ships log messages to a storage volume from a background thread.
+    
+    Instead of downloading and re-uploading the whole log file for every message, each log path is
+    written locally as segment files <log name>.<process start time>.<segment number><extension> of at
+    most EDI_LOG_SEGMENT_SIZE bytes (default 256 KB). Segments written to are uploaded every
+    EDI_LOG_FLUSH_INTERVAL seconds (default 10), or earlier once EDI_LOG_FLUSH_SIZE bytes (default 64 KB)
+    are waiting; a flush only uploads the segments changed since the last one.
+    
+    The storage volumes api cannot append to a file, so each flush uploads the whole current segment
+    again: a segment of size S flushed every g bytes is sent about S / g times, on average half full,
+    i.e., the upload traffic is about S / (2 * g) times the size of the log. Keep the segment size a few
+    times the flush size; larger segments only mean fewer files.
+    """
+    def __init__(self, flush_interval: float = None, flush_size: int = None, segment_size: int = None):
+        self.flush_interval = float(sv.fill_in_default_if_none(flush_interval, 'EDI_LOG_FLUSH_INTERVAL', 10))
+        self.flush_size = int(sv.fill_in_default_if_none(flush_size, 'EDI_LOG_FLUSH_SIZE', 64 * 1024))
+        self.segment_size = int(sv.fill_in_default_if_none(segment_size, 'EDI_LOG_SEGMENT_SIZE', 256 * 1024))
+        self.start_time = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        self.segments = {} # log path -> current segment number
+        self.pending = {} # segment path -> (access token, storage volume) of segments changed since the last upload
+        self.size_pending = 0 # bytes written to pending segments
+        self.lock = threading.Lock() # guards segments, pending and size_pending
+        self.event_flush = threading.Event()
+        self.lock_flush = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='LogShipper')
+        self.thread.start()
+    
+    def write(self, path_source: str, lines: List[str], access_token: str = None,
+              volume_display_name: str = None) -> None:
+        """Append lines to the current segment of the log at path_source and queue it for upload,
+        without waiting for any upload."""
+        data = ''.join(f"{x}\n" for x in lines)
+        with self.lock:
+            path_segment = self.get_segment_path(path_source)
+            with open(path_segment, 'a') as file:
+                file.write(data)
+            self.pending[path_segment] = (access_token, volume_display_name) # the latest token is the least likely to have expired
+            self.size_pending += len(data)
+            flush = self.size_pending >= self.flush_size
+        if flush:
+            self.event_flush.set()
+    
+    def run(self) -> None:
+        while True:
+            self.event_flush.wait(self.flush_interval)
+            self.event_flush.clear()
+            try:
+                self.ship()
+            except Exception as e:
+                print(f'Failed to ship log: {e}')
+    
+    def flush(self, timeout: float = 60) -> None:
+        """Ship everything queued so far, in the calling thread."""
+        if self.lock_flush.acquire(timeout=timeout):
             try:
-                Kernel.log_info(f'No filename provided for log...defaulting to {backup_name}')
-            except:
-                pass
+                self.ship_locked()
+            finally:
+                self.lock_flush.release()
+    
+    def ship(self) -> None:
+        with self.lock_flush:
+            self.ship_locked()
+    
+    def ship_locked(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.size_pending = 0
         
-        LOG_LOCAL_PATH = path_source
-        LOG_DIRNAME = os.path.dirname(LOG_LOCAL_PATH)
-        LOG_FILENAME = os.path.basename(LOG_LOCAL_PATH)
+        for path_segment, (access_token, volume_display_name) in pending.items():
+            try:
+                # the target is the segment file itself, no need to list its directory to find out
+                sv.upload(path_segment, path_target=path_segment, access_token=access_token,
+                          volume_display_name=volume_display_name, path_target_type='file')
+            except Exception as e: # the segment stays on local disk and is uploaded again with the next flush
+                print(f'Failed to upload log segment {path_segment}: {e}')
+                with self.lock:
+                    self.pending.setdefault(path_segment, (access_token, volume_display_name))
+    
+    def get_segment_path(self, path_source: str) -> str:
+        """Path of the segment to append to for a log, starting a new segment once the current one is full.
+        Called with self.lock held."""
+        name, ext = os.path.splitext(path_source)
+        segment = self.segments.get(path_source, 0)
+        path_segment = f'{name}.{self.start_time}.{segment:03d}{ext}'
+        if os.path.exists(path_segment) and os.path.getsize(path_segment) >= self.segment_size:
+            segment += 1
+            path_segment = f'{name}.{self.start_time}.{segment:03d}{ext}'
+        self.segments[path_source] = segment
+        return path_segment
 
-        try:
-            file_list = sv.list_files(LOG_DIRNAME, access_token=access_token)
-        except:
-            file_list = None
-        else:
-            if file_list is not None and LOG_FILENAME in file_list:
-                sv.download(LOG_LOCAL_PATH, access_token=access_token)
 
-    # Write to internal storage regardless
-    os.makedirs(LOG_DIRNAME, exist_ok=True)
-    with open(LOG_LOCAL_PATH, 'a') as file:
-        file.writelines(f"{x}\n" for x in message)
+_log_shipper = None
+_log_shipper_lock = threading.Lock()
 
-    if save_log_to_volume:
-        sv.upload(LOG_LOCAL_PATH, access_token=access_token)
+def get_log_shipper() -> LogShipper:
+    """Get the LogShipper of this process, starting it on first use."""
+    global _log_shipper
+    with _log_shipper_lock:
+        if _log_shipper is None:
+            _log_shipper = LogShipper()
+            atexit.register(flush_log)
+    return _log_shipper
         
         
 def run_subprocess(cmd: str) -> str:
@@ -116,6 +235,218 @@ def run_subprocess_and_retry(cmd: str, verification_str: str, delay=3,
             sleep(delay)
     return out
 
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on a lock file, e.g., to let only one of several kernels
+    sharing a directory run a step at a time
+        Args:
+            path: path to the lock file, created if needed
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def install_requirements(path_requirements: str, dir_target: str, dir_wheelhouse: str,
+                         find_links: Optional[List[str]] = None) -> None:
+    """Install the requirements missing in the current environment into dir_target, once per
+    content of the requirements file
+        Args:
+            path_requirements: path to requirements.txt
+            dir_target: directory to install packages to (pip --target), shared by all kernels
+            dir_wheelhouse: directory to keep downloaded wheels in, shared by all kernels
+            find_links: additional pip --find-links locations, e.g., the pytorch wheel index
+        Notes:
+            Once installed, a marker with the hash of the requirements file is written to dir_target;
+            kernels started afterwards only check the marker and skip version checks and pip entirely.
+            Wheels are downloaded into dir_wheelhouse/<hash> and installed from there without an index.
+            A file lock makes concurrently starting kernels install only once.
+    """
+    with open(path_requirements, 'rb') as f:
+        content = f.read()
+    requirements_hash = hashlib.sha256(content).hexdigest()[:16]
+    path_marker = os.path.join(dir_target, f'.requirements-{requirements_hash}')
+    if os.path.exists(path_marker):
+        print(f'Requirements {requirements_hash} already installed in {dir_target}')
+        return
+    
+    os.makedirs(dir_target, exist_ok=True)
+    with file_lock(os.path.join(dir_target, '.install.lock')):
+        if os.path.exists(path_marker): # installed by another kernel while waiting for the lock
+            print(f'Requirements {requirements_hash} already installed in {dir_target}')
+            return
+        
+        import pkg_resources
+        installed_packages = {pkg.key:pkg.version for pkg in pkg_resources.WorkingSet()}
+        requirements_new = []
+        for req in pkg_resources.parse_requirements(content.decode()):
+            if req.key in installed_packages and req.specifier.contains(installed_packages[req.key], prereleases=True):
+                print(f'{req}: already installed')
+            else:
+                print(f'{req}: wait to be installed')
+                requirements_new.append(str(req))
+        
+        if len(requirements_new) > 0:
+            find_links = [] if find_links is None else find_links
+            args_find_links = [arg for link in find_links for arg in ['--find-links', link]]
+            dir_wheels = os.path.join(dir_wheelhouse, requirements_hash)
+            path_requirements_new = os.path.join(dir_wheels, 'requirements.txt')
+            
+            if not os.path.exists(os.path.join(dir_wheels, '.complete')):
+                shutil.rmtree(dir_wheels, ignore_errors=True) # leftover of an interrupted download
+                os.makedirs(dir_wheels)
+                with open(path_requirements_new, 'w') as f:
+                    f.writelines(f'{req}\n' for req in requirements_new)
+                print(f'Download wheels to {dir_wheels}')
+                out = subprocess.check_output([sys.executable, '-m', 'pip', 'download', '-r', path_requirements_new,
+                                               '-d', dir_wheels] + args_find_links,
+                                              text=True, stderr=subprocess.STDOUT)
+                print(out)
+                open(os.path.join(dir_wheels, '.complete'), 'w').close()
+            
+            out = subprocess.check_output([sys.executable, '-m', 'pip', 'install', '--no-index', '--find-links', dir_wheels,
+                                           '-r', path_requirements_new, f'--target={dir_target}'],
+                                          text=True, stderr=subprocess.STDOUT)
+            print(out)
+        
+        with open(path_marker, 'w') as f:
+            f.writelines(f'{req}\n' for req in requirements_new)
+
+
+def get_provision_marker_path(path_archive: str, dir_extract: Optional[str] = None) -> str:
+    """Path to the version marker written by provision_archive(): inside the extracted directory, or next to the
+    archive if it is not extracted
+        Args:
+            path_archive: path to the zip archive
+            dir_extract: directory the archive is extracted to, if any
+    """
+    if dir_extract is None:
+        return os.path.join(os.path.dirname(path_archive), f'.{os.path.basename(path_archive)}.provisioned')
+    return os.path.join(dir_extract, '.provisioned')
+
+
+def read_provision_marker(path_marker: str) -> Optional[dict]:
+    """Read a version marker written by provision_archive(), or None if it does not exist (yet)
+        Args:
+            path_marker: path to the marker, see get_provision_marker_path()
+    """
+    try:
+        with open(path_marker) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def provision_archive(path_archive: str, dir_extract: Optional[str] = None, fetch: Optional[Callable[[str], None]] = None,
+                      checksum: Optional[str] = None) -> None:
+    """Make sure an archive is present and verified, and optionally extracted, coordinating kernels that share the
+    directory so that only one of them downloads and extracts it
+        Args:
+            path_archive: path to the zip archive
+            dir_extract: directory to extract the archive to; if None, the archive is only fetched and verified
+            fetch: function that downloads the archive to the path it is given, called if path_archive does not exist
+            checksum: expected checksum of the archive as "<algorithm>:<hex digest>", e.g., "sha256:9f86d0..."
+        Notes:
+            The archive is downloaded to a temporary path and only moved to path_archive once verified, and it is
+            extracted to a temporary directory that is renamed to dir_extract, so no kernel observes a partial file
+            or a half-extracted directory. A marker with the size, mtime and checksum of the archive is written to the
+            extracted directory (or next to the archive); kernels started afterwards only compare the marker with the
+            archive and skip the rest.
+            If the archive has a single top-level folder named like dir_extract, its content is what ends up in
+            dir_extract.
+    """
+    path_archive = os.path.abspath(path_archive)
+    if checksum is not None and ':' not in checksum:
+        raise Exception(f'FAILED: checksum {checksum} is not in the format <algorithm>:<hex digest>')
+    
+    def is_provisioned():
+        if not os.path.exists(path_archive):
+            return False
+        marker = read_provision_marker(get_provision_marker_path(path_archive, dir_extract))
+        if marker is None:
+            return False
+        stat = os.stat(path_archive)
+        if (marker.get('size'), marker.get('mtime')) != (stat.st_size, stat.st_mtime):
+            return False
+        return checksum is None or marker.get('checksum') == checksum.lower()
+    
+    if is_provisioned():
+        print(f'{path_archive} already provisioned')
+        return
+    
+    dir_archive = os.path.dirname(path_archive)
+    os.makedirs(dir_archive, exist_ok=True)
+    with file_lock(f'{path_archive}.lock'):
+        if is_provisioned(): # provisioned by another kernel while waiting for the lock
+            print(f'{path_archive} already provisioned')
+            return
+        
+        algorithm = 'sha256' if checksum is None else checksum.split(':')[0].lower()
+        if os.path.exists(path_archive):
+            digest = sv.file_digest(path_archive, algorithm)
+            if checksum is not None and f'{algorithm}:{digest}' != checksum.lower():
+                if fetch is None:
+                    raise Exception(f'FAILED: checksum of {path_archive} does not match {checksum}')
+                print(f'Checksum of {path_archive} does not match {checksum}, fetching it again')
+                os.remove(path_archive)
+        
+        if not os.path.exists(path_archive):
+            if fetch is None:
+                raise Exception(f'FAILED: {path_archive} does not exist')
+            path_tmp = os.path.join(dir_archive, f'.{os.path.basename(path_archive)}.{uuid.uuid4().hex}.part')
+            try:
+                t_s = time.time()
+                fetch(path_tmp)
+                print(f'Fetched {path_archive} in {time.time() - t_s:.1f}s')
+                digest = sv.file_digest(path_tmp, algorithm)
+                if checksum is not None and f'{algorithm}:{digest}' != checksum.lower():
+                    raise Exception(f'FAILED: checksum {algorithm}:{digest} of fetched {path_archive} does not match {checksum}')
+                with zipfile.ZipFile(path_tmp) as z:
+                    member_bad = z.testzip()
+                if member_bad is not None:
+                    raise Exception(f'FAILED: fetched {path_archive} is corrupted at {member_bad}')
+                os.replace(path_tmp, path_archive)
+            finally:
+                if os.path.exists(path_tmp):
+                    os.remove(path_tmp)
+        
+        stat = os.stat(path_archive)
+        marker = {'archive': os.path.basename(path_archive), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                  'checksum': f'{algorithm}:{digest}', 'provisioned_at': datetime.now().isoformat()}
+        if dir_extract is None:
+            path_marker = get_provision_marker_path(path_archive)
+            with open(f'{path_marker}.{uuid.uuid4().hex}.tmp', 'w') as f:
+                json.dump(marker, f)
+            os.replace(f.name, path_marker)
+            return
+        
+        # extract next to the target and swap the directory in with renames
+        dir_extract = os.path.abspath(dir_extract)
+        dir_tmp = f'{dir_extract}.{uuid.uuid4().hex}.tmp'
+        dir_old = f'{dir_extract}.{uuid.uuid4().hex}.old'
+        try:
+            t_s = time.time()
+            with zipfile.ZipFile(path_archive) as z:
+                z.extractall(dir_tmp)
+            dir_src = dir_tmp
+            if os.listdir(dir_tmp) == [os.path.basename(dir_extract)] and os.path.isdir(os.path.join(dir_tmp, os.path.basename(dir_extract))):
+                dir_src = os.path.join(dir_tmp, os.path.basename(dir_extract))
+            
+            with open(get_provision_marker_path(path_archive, dir_src), 'w') as f:
+                json.dump(marker, f)
+            
+            if os.path.exists(dir_extract):
+                os.rename(dir_extract, dir_old)
+            os.rename(dir_src, dir_extract)
+            print(f'Extracted {path_archive} to {dir_extract} in {time.time() - t_s:.1f}s')
+        finally:
+            shutil.rmtree(dir_tmp, ignore_errors=True)
+            shutil.rmtree(dir_old, ignore_errors=True)
+
+
 def get_deployment_view_item(deployment_name: str, search_str: str) -> str:
     """Gets the value of a status item from dlim view API
         Args:
@@ -166,6 +497,25 @@ def serialize_image(img: Image) -> str:
     return base64.b64encode(buffer.getvalue()).decode('utf-8')
 
 
+def serialize_image_file(path: str, image_format: Optional[str] = None) -> str:
+    """Serialize an image file into a UTF-8 string
+        Args:
+            path: path to an image file
+            image_format: None to send the file content as it is, without decoding and encoding it
+                          again; or a PIL format to convert to first, e.g., 'WEBP' (saved lossless)
+        Returns:
+            str
+    """
+    if image_format is None:
+        with open(path, 'rb') as f:
+            return base64.b64encode(f.read()).decode('utf-8')
+    
+    buffer = BytesIO()
+    with Image.open(path) as img:
+        img.save(buffer, image_format, lossless=True)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
 def deserialize_image(bs: str) -> Image:
     """Deserializes a string back into a BytesIO object/Image
         Args:
@@ -173,4 +523,128 @@ def deserialize_image(bs: str) -> Image:
         Returns:
             BytesIO/Image object
     """
-    return BytesIO(base64.b64decode(bs))
\ No newline at end of file
+    return BytesIO(base64.b64decode(bs))
+
+def result_cache_key(input_dir: str, tile_size: int, model_name: str, precision: str = 'fp32',
+                     backend: str = 'torchscript', artifacts: Dict[str, str] = None) -> str:
+    """Compute the result cache key of an inference request
+        Args:
+            input_dir: directory containing the input image(s) of the request
+            tile_size: tile size used for inference
+            model_name: model file name, so that results of another model version are never reused
+            precision: precision of the nets (DEEPLIIF_PRECISION)
+            backend: backend running the nets (DEEPLIIF_BACKEND)
+            artifacts: identity of the files the nets were loaded from, net name -> description
+                       (see deepliif.models.get_net_artifacts), as the variant init_nets picks changes the outputs
+        Returns:
+            hex digest over the decoded pixels and filenames of the input images, tile_size and the model settings
+        Notes:
+            pixels are hashed rather than file bytes, so re-encoded copies of the same image share results
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f'{model_name}|{tile_size}|{precision}|{backend}|'.encode())
+    h.update(json.dumps(artifacts, sort_keys=True).encode())
+    for filename in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, filename)
+        if not os.path.isfile(path):
+            continue
+        h.update(f'|{filename}|'.encode())
+        try:
+            with Image.open(path) as img:
+                h.update(f'{img.mode}|{img.size}|'.encode())
+                h.update(img.tobytes())
+        except Exception:
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def result_cache_get(cache_dir: str, key: str, output_dir: str) -> bool:
+    """Copy a cached inference result into output_dir
+        Args:
+            cache_dir: directory of the result cache
+            key: cache key from result_cache_key
+            output_dir: directory to place the cached output files in
+        Returns:
+            True on a cache hit, False otherwise
+    """
+    path = os.path.join(cache_dir, key)
+    copied = []
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        for filename in os.listdir(path):
+            dst = os.path.join(output_dir, filename)
+            # copied rather than hard linked: a later request with the same output_dir rewrites
+            # these files in place, which must never reach the cache entry
+            shutil.copy2(os.path.join(path, filename), dst)
+            copied.append(dst)
+        os.utime(path) # mark as recently used
+    except OSError: # not cached, or evicted while being read
+        # remove partial results so that inference does not mix them with its own output
+        for dst in copied:
+            os.remove(dst)
+        return False
+    return True
+
+
+def result_cache_put(cache_dir: str, key: str, output_dir: str,
+                     max_size: Optional[int] = None, max_age: Optional[float] = None) -> bool:
+    """Store the output files of an inference request in the result cache, then evict old entries
+        Args:
+            cache_dir: directory of the result cache
+            key: cache key from result_cache_key
+            output_dir: directory with the output files to store
+            max_size: upper limit of the cache size in bytes, evicting least recently used entries first
+            max_age: maximum number of seconds since an entry was last used
+        Returns:
+            True if the result was stored, False otherwise; failures never affect the request itself
+    """
+    path = os.path.join(cache_dir, key)
+    path_tmp = os.path.join(cache_dir, f'.{key}.{uuid.uuid4().hex}')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        shutil.copytree(output_dir, path_tmp)
+        try:
+            os.rename(path_tmp, path) # atomic, readers never see a partial entry
+        except OSError: # the same result has been stored by a concurrent request
+            shutil.rmtree(path_tmp, ignore_errors=True)
+        os.utime(path)
+    except OSError as e:
+        print(f'Failed to store result in cache: {e}')
+        shutil.rmtree(path_tmp, ignore_errors=True)
+        return False
+    result_cache_evict(cache_dir, max_size, max_age)
+    return True
+
+
+def result_cache_evict(cache_dir: str, max_size: Optional[int] = None, max_age: Optional[float] = None) -> None:
+    """Evict result cache entries by age and then by least recent use until the cache fits in max_size
+        Args:
+            cache_dir: directory of the result cache
+            max_size: upper limit of the cache size in bytes; None for no limit
+            max_age: maximum number of seconds since an entry was last used; None for no limit
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            mtime = os.stat(path).st_mtime
+            if name.startswith('.'): # leftover of an interrupted result_cache_put
+                if now - mtime > 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        except OSError: # evicted by another request
+            continue
+        entries.append((mtime, size, path))
+    
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        expired = max_age is not None and now - mtime > max_age
+        oversized = max_size is not None and total_size > max_size
+        if not (expired or oversized):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size